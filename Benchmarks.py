@@ -0,0 +1,84 @@
+# BENCHMARKS.PY
+# Microbenchmarks and consistency checks for the game engine - run
+# "python Benchmarks.py"
+
+import random
+import time
+import Gamestate
+import Boards
+import Pieces
+import Rollouts
+
+def midgameState(plies = 24, seed = 0):
+    """Return a gamestate reached by playing plies random moves, with its move caches filled."""
+    rng = random.Random(seed)
+    gamestate = Gamestate.Gamestate()
+    for i in range(plies):
+        gamestate.update(rng.choice(gamestate.listMoves()))
+    for color in range(1, 5):
+        gamestate.listMoves()
+        gamestate.advanceTurn()
+    return gamestate
+
+def timeRate(function, seconds = 2.0, batch = 100):
+    """Call function repeatedly for about seconds and return calls per second."""
+    calls = 0
+    start_time = time.time()
+    while time.time() - start_time < seconds:
+        for i in range(batch):
+            function()
+        calls = calls + batch
+    return calls / (time.time() - start_time)
+
+def benchmarkDuplicate(seconds = 2.0):
+    """Return duplicates per second of a midgame gamestate."""
+    gamestate = midgameState()
+    return timeRate(gamestate.duplicate, seconds)
+
+def benchmarkDuplicateUpdate(seconds = 2.0):
+    """Return duplicate-then-update pairs per second from a midgame gamestate, as when expanding a search node."""
+    gamestate = midgameState()
+    move = gamestate.listMoves()[0]
+    return timeRate(lambda: gamestate.duplicate().update(move), seconds)
+
+def benchmarkRollouts(policy, seconds = 2.0):
+    """Return rollouts per second from the opening with a Rollouts policy."""
+    gamestate = Gamestate.Gamestate()
+    return timeRate(lambda: Rollouts.rollout(gamestate, policy), seconds, batch = 1)
+
+def checkMoveGeneration(games = 1, seed = 0):
+    """Play random games checking at every turn that move generation finds each legal move exactly once; return the number of positions checked."""
+    rng = random.Random(seed)
+    checked = 0
+    for game in range(games):
+        gamestate = Gamestate.Gamestate()
+        while not gamestate.isTerminal():
+            color = gamestate.turn
+            generated = list()
+            if gamestate.hands[color - 1] and gamestate.getCorners(color):
+                for name in gamestate.sortedHand(color):
+                    for entry in Pieces.orientationTable[name]:
+                        generated.extend(gamestate.findPieceMoves(entry))
+            if len(generated) != len(set(generated)):
+                raise AssertionError("duplicate moves generated at %d" % checked)
+            expected = gamestate.bruteForceMoves()
+            if set(generated) != expected:
+                raise AssertionError("found %d moves, expected %d at %d"
+                                     % (len(set(generated)), len(expected), checked))
+            moves = gamestate.listMoves()
+            if set(moves[:-1]) != expected or len(moves[:-1]) != len(expected):
+                raise AssertionError("listMoves gave %d moves, expected %d at %d"
+                                     % (len(moves[:-1]), len(expected), checked))
+            checked = checked + 1
+            gamestate.update(rng.choice(moves) if moves else list())
+    return checked
+
+if __name__ == '__main__':
+    print("move generation: %d positions checked" % checkMoveGeneration())
+    for backendType in [Boards.ArrayBoard, Boards.Bitboard]:
+        Gamestate.Gamestate.backendType = backendType
+        print("%s:" % backendType.__name__)
+        print("  duplicate: %.0f per second" % benchmarkDuplicate())
+        print("  duplicate + update: %.0f per second" % benchmarkDuplicateUpdate())
+        for policy in Rollouts.policies:
+            print("  %s rollouts: %.1f per second" % (policy, benchmarkRollouts(policy)))
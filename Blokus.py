@@ -9,6 +9,7 @@ import HumanPlayer
 import MaxnPlayers
 import MCTSPlayers
 import Gamestate
+import Placements
 
 # Initialize current gamestate variable
 curr = Gamestate.Gamestate()
@@ -24,7 +25,7 @@ for i in range(1,5):
     while not success:
         try:
             n = int(raw_input())
-            if n!=0 and n!= 1 and n!=2 and n!= 3 and n!= 4 and n!=5 and n!=6:
+            if n!=0 and n!= 1 and n!=2 and n!= 3 and n!= 4 and n!=5 and n!=6 and n!=7 and n!=8 and n!=9 and n!=10:
                 print("Please enter zero or one only")
             else:
                 success = True
@@ -45,6 +46,14 @@ for i in range(1,5):
         players[i] = MCTSPlayers.persistentMCPlayer(i)
     if n == 6:
         players[i] = Players.weightedRandomPlayer(i)
+    if n == 7:
+        players[i] = MCTSPlayers.rootParallelMCPlayer(i)
+    if n == 8:
+        players[i] = MCTSPlayers.leafParallelMCPlayer(i)
+    if n == 9:
+        players[i] = MCTSPlayers.treeParallelMCPlayer(i)
+    if n == 10:
+        players[i] = MCTSPlayers.compactMCPlayer(i)
 
 # MAIN GAME LOOP
 # Quit when curr is terminal (aka four consecutive passes have occurred)
@@ -55,13 +64,14 @@ while not curr.isTerminal():
     success = False
     while not success:
         # Ask for move
-        move = players[curr.turn].getMove(curr.duplicate())
-        # A pass is a single string ('pass!') and has len = 5; otherwise len = 4
-        if len(move) != 4:
+        # Players may answer with a placement ID, a (name, orientation, xmin,
+        # ymin) tuple or a pass ('pass!' or list())
+        move = Placements.moveId(players[curr.turn].getMove(curr.duplicate()))
+        if move == Placements.PASS:
             print("Passing!")
             curr.update(move)
             success = True
-        elif curr.update(move) != False:
+        elif move is not None and curr.update(move) != False:
             success = True
         else:
             print("Invalid move!") 
@@ -0,0 +1,377 @@
+# BOARDS.PY
+# Board backends for Gamestate: how placed tiles are stored, and how a
+# proposed placement is tested against them
+
+# Bitboards index squares row by row on a board padded with a one-square
+# ring of off-board squares, so shifting a mask by one row or column never
+# wraps a tile onto the opposite edge
+
+import binascii
+import numpy as np
+import Pieces
+
+boardsize = 20
+width = boardsize + 2
+
+# Off-board squares diagonal to each color's starting corner. A color's first
+# piece is placed as if it touched a tile of its own here.
+startTiles = {1: (-1, -1),
+              2: (boardsize, -1),
+              3: (boardsize, boardsize),
+              4: (-1, boardsize)}
+
+def cellIndex(x, y):
+    """Return the bit index of board square (x, y) in a padded bitboard."""
+    return (y + 1) * width + (x + 1)
+
+# Diagonal directions, numbered so that a corner of the board can be stored
+# as the small int cellIndex * 4 + direction
+diagonals = ((-1, -1), (1, -1), (-1, 1), (1, 1))
+
+def cornerKey(x, y, dx, dy):
+    """Return the key of open square (x, y) whose own-color tile lies in direction (dx, dy)."""
+    return cellIndex(x, y) * 4 + diagonals.index((dx, dy))
+
+def cornerSquare(key):
+    """Return the (x, y) square of a corner key."""
+    cell = key >> 2
+    return (cell % width - 1, cell // width - 1)
+
+def cellsMask(cells):
+    """Return the bitboard with the given (x, y) squares set."""
+    mask = 0
+    for x, y in cells:
+        mask |= 1 << cellIndex(x, y)
+    return mask
+
+def maskToArray(mask):
+    """Return a boardsize x boardsize boolean array of the squares set in a bitboard."""
+    nbytes = (width * width + 7) // 8
+    raw = binascii.unhexlify('%0*x' % (2 * nbytes, mask))
+    bits = np.unpackbits(np.frombuffer(raw, dtype=np.uint8))[::-1]
+    return bits[:width * width].reshape(width, width)[1:-1, 1:-1].astype(bool)
+
+def arrayToMask(bits):
+    """Return the bitboard with bit i set where the flat width*width boolean array bits is true."""
+    padding = -len(bits) % 8
+    raw = np.packbits(bits[::-1]).tobytes()
+    return int(binascii.hexlify(raw), 16) >> padding
+
+def floodFill(seed, free):
+    """Return the squares of bitboard free connected to seed, through free squares sharing an edge or corner."""
+    rtn = seed & free
+    while True:
+        grow = rtn | (rtn << 1) | (rtn >> 1)
+        grow = (grow | (grow << width) | (grow >> width)) & free
+        if grow == rtn:
+            return rtn
+        rtn = grow
+
+def initBorder():
+    """Return the bitboard of the off-board ring of squares."""
+    inside = cellsMask([(x, y) for x in range(boardsize) for y in range(boardsize)])
+    return ((1 << (width * width)) - 1) & ~inside
+
+def initEntryMasks():
+    """Return the bitboard of each orientation's cells placed at (0, 0), keyed by (name, orientation)."""
+    rtn = dict()
+    for name, entries in Pieces.orientationTable.items():
+        for entry in entries:
+            rtn[(name, entry.orientation)] = cellsMask(entry.cells)
+    return rtn
+
+def initEntryOffsets():
+    """Return (offsets, shapes) keyed by (name, orientation): padded flat indices of each orientation's cells placed at (0, 0), and its cells as a height x width boolean array."""
+    offsets = dict()
+    shapes = dict()
+    for name, entries in Pieces.orientationTable.items():
+        for entry in entries:
+            offsets[(name, entry.orientation)] = np.array([cellIndex(x, y) for x, y in entry.cells])
+            shape = np.zeros((entry.height, entry.width), dtype=bool)
+            for x, y in entry.cells:
+                shape[y, x] = True
+            shapes[(name, entry.orientation)] = shape
+    return offsets, shapes
+
+class Board(object):
+    """Abstract board backend."""
+
+    def copy(self):
+        """Return an independent copy of this board."""
+        pass
+
+    def toArray(self):
+        """Return the board as a boardsize x boardsize int array of colors."""
+        pass
+
+    def fits(self, color, entry, xmin, ymin):
+        """Return whether orientation entry at (xmin, ymin) is on the board, unoccupied and not edge adjacent to color."""
+        pass
+
+    def legal(self, color, entry, xmin, ymin):
+        """Return whether orientation entry at (xmin, ymin) fits and touches color at a corner."""
+        pass
+
+    def place(self, color, entry, xmin, ymin):
+        """Put orientation entry down at (xmin, ymin) in color, and return what unplace needs to take it back."""
+        pass
+
+    def unplace(self, color, changes):
+        """Take back the most recent placement by color, given what place returned."""
+        pass
+
+    def isAnchor(self, color, cell):
+        """Return whether padded square cell is free, allowed for color and diagonal to its tiles."""
+        pass
+
+    def freeMask(self, color):
+        """Return the bitboard of squares color may still cover - on the board, free and not edge adjacent to its tiles."""
+        pass
+
+    def anchorMask(self, color):
+        """Return the bitboard of color's anchors (see isAnchor)."""
+        pass
+
+class ArrayBoard(Board):
+    """Board stored as a padded array of colors, with per-color boolean masks for legality tests."""
+
+    entryOffsets, entryShapes = initEntryOffsets()
+
+    def __init__(self, grid = None):
+        # All state lives in one 9 x width*width byte buffer, so copying a
+        # board is a single buffer copy. Views into it:
+        # tiles: padded width x width array of colors, off-board ring is 0
+        # forbidden: per color, squares it may not use - off-board, occupied,
+        #     or edge adjacent to its own tiles
+        # anchors: per color, allowed squares diagonal to its own tiles
+        # Masks are stored flat so a placement is one fancy-indexed lookup
+        self.setBuffer(np.zeros((9, width * width), dtype=np.uint8))
+        if grid is not None:
+            self.tiles[1:-1, 1:-1] = grid
+        self.deriveMasks()
+
+    def setBuffer(self, buffer):
+        """Make buffer this board's storage and point the views at it."""
+        self.buffer = buffer
+        self.tiles = buffer[0].reshape(width, width)
+        self.forbidden = buffer[1:5].view(bool)
+        self.anchors = buffer[5:9].view(bool)
+
+    def __getstate__(self):
+        """Return what pickling needs: the buffer alone, since the views would be pickled as separate copies."""
+        return {'buffer': self.buffer}
+
+    def __setstate__(self, state):
+        self.setBuffer(state['buffer'])
+
+    @classmethod
+    def fromArray(cls, grid):
+        """Return a board with the tiles of the int array grid."""
+        return cls(grid)
+
+    def deriveMasks(self):
+        """Recompute every color's forbidden and anchor masks from the whole board."""
+        forbidden = self.forbidden.reshape(4, width, width)
+        anchors = self.anchors.reshape(4, width, width)
+        for color in range(1, 5):
+            own = self.tiles == color
+            forb = forbidden[color - 1]
+            forb[:] = self.tiles != 0
+            forb[0, :] = forb[-1, :] = forb[:, 0] = forb[:, -1] = True
+            forb[:-1, :] |= own[1:, :]
+            forb[1:, :] |= own[:-1, :]
+            forb[:, :-1] |= own[:, 1:]
+            forb[:, 1:] |= own[:, :-1]
+            anch = anchors[color - 1]
+            anch[:] = False
+            if own.any():
+                anch[:-1, :-1] |= own[1:, 1:]
+                anch[:-1, 1:] |= own[1:, :-1]
+                anch[1:, :-1] |= own[:-1, 1:]
+                anch[1:, 1:] |= own[:-1, :-1]
+            else:
+                x, y = startTiles[color]
+                anch.flat[cellIndex(min(max(x, 0), boardsize - 1),
+                                    min(max(y, 0), boardsize - 1))] = True
+            anch &= ~forb
+
+    def copy(self):
+        rtn = ArrayBoard.__new__(ArrayBoard)
+        rtn.setBuffer(self.buffer.copy())
+        return rtn
+
+    def toArray(self):
+        return self.tiles[1:-1, 1:-1]
+
+    def placementIndices(self, entry, xmin, ymin):
+        """Return flat indices of entry placed at (xmin, ymin), or None if it sticks off the board."""
+        if (xmin < 0 or ymin < 0 or xmin + entry.width > boardsize
+            or ymin + entry.height > boardsize):
+            return None
+        return ArrayBoard.entryOffsets[(entry.name, entry.orientation)] + (ymin * width + xmin)
+
+    def fits(self, color, entry, xmin, ymin):
+        indices = self.placementIndices(entry, xmin, ymin)
+        if indices is None:
+            return False
+        return not self.forbidden[color - 1, indices].any()
+
+    def legal(self, color, entry, xmin, ymin):
+        indices = self.placementIndices(entry, xmin, ymin)
+        if indices is None:
+            return False
+        return (not self.forbidden[color - 1, indices].any()
+                and self.anchors[color - 1, indices].any())
+
+    def isAnchor(self, color, cell):
+        return self.anchors[color - 1, cell]
+
+    def freeMask(self, color):
+        return arrayToMask(~self.forbidden[color - 1])
+
+    def anchorMask(self, color):
+        return arrayToMask(self.anchors[color - 1])
+
+    def place(self, color, entry, xmin, ymin):
+        indices = self.placementIndices(entry, xmin, ymin)
+        shape = ArrayBoard.entryShapes[(entry.name, entry.orientation)]
+        rows = slice(ymin, ymin + entry.height + 2)
+        cols = slice(xmin, xmin + entry.width + 2)
+        forb = self.forbidden[color - 1].reshape(width, width)[rows, cols]
+        anch = self.anchors[color - 1].reshape(width, width)[rows, cols]
+        changes = (indices, rows, cols, self.forbidden[:, indices], self.anchors[:, indices],
+                   forb.copy(), anch.copy())
+
+        # Tiles are occupied, and no longer anchors, for every color
+        self.tiles.flat[indices] = color
+        self.forbidden[:, indices] = True
+        self.anchors[:, indices] = False
+
+        # Within a one-square frame around the piece, its edge neighbours
+        # become forbidden to its color and its free diagonals anchors
+        forb[:-2, 1:-1] |= shape
+        forb[2:, 1:-1] |= shape
+        forb[1:-1, :-2] |= shape
+        forb[1:-1, 2:] |= shape
+        anch[:-2, :-2] |= shape
+        anch[:-2, 2:] |= shape
+        anch[2:, :-2] |= shape
+        anch[2:, 2:] |= shape
+        anch &= ~forb
+        return changes
+
+    def unplace(self, color, changes):
+        indices, rows, cols, forbidden, anchors, forb, anch = changes
+        # Restore the frame first, since it overlaps the piece's tiles
+        self.forbidden[color - 1].reshape(width, width)[rows, cols] = forb
+        self.anchors[color - 1].reshape(width, width)[rows, cols] = anch
+        self.tiles.flat[indices] = 0
+        self.forbidden[:, indices] = forbidden
+        self.anchors[:, indices] = anchors
+
+class Bitboard(Board):
+    """Board stored as one padded bitboard per color, with derived masks for legality tests."""
+
+    border = initBorder()
+    allSquares = (1 << (width * width)) - 1
+    entryMasks = initEntryMasks()
+    startAnchors = dict((color, cellsMask([(min(max(x, 0), boardsize - 1),
+                                            min(max(y, 0), boardsize - 1))]))
+                        for color, (x, y) in startTiles.items())
+
+    def __init__(self, tiles = None):
+        # tiles: own tiles of each color
+        # occupied: tiles of any color
+        # forbidden: squares a color may not use besides occupied ones -
+        #     off-board squares and squares edge adjacent to its own tiles
+        # anchors: free, allowed squares diagonal to a color's own tiles
+        if tiles is None:
+            tiles = [0, 0, 0, 0]
+        self.tiles = tiles
+        self.occupied = 0
+        for mask in tiles:
+            self.occupied |= mask
+        self.forbidden = [0, 0, 0, 0]
+        self.anchors = [0, 0, 0, 0]
+        for color in range(1, 5):
+            self.deriveMasks(color)
+
+    @classmethod
+    def fromArray(cls, grid):
+        """Return a bitboard with the same tiles as the int array grid."""
+        tiles = [0, 0, 0, 0]
+        for y, x in zip(*np.nonzero(grid)):
+            tiles[int(grid[y,x]) - 1] |= 1 << cellIndex(int(x), int(y))
+        return cls(tiles)
+
+    def deriveMasks(self, color):
+        """Recompute color's forbidden and anchor masks from its tiles."""
+        own = self.tiles[color - 1]
+        edges = (own << 1) | (own >> 1) | (own << width) | (own >> width)
+        self.forbidden[color - 1] = Bitboard.border | edges
+        if own == 0:
+            diagonals = Bitboard.startAnchors[color]
+        else:
+            diagonals = ((own << (width + 1)) | (own << (width - 1))
+                         | (own >> (width - 1)) | (own >> (width + 1)))
+        self.anchors[color - 1] = diagonals & ~(self.forbidden[color - 1] | self.occupied)
+
+    def copy(self):
+        rtn = Bitboard.__new__(Bitboard)
+        rtn.tiles = list(self.tiles)
+        rtn.occupied = self.occupied
+        rtn.forbidden = list(self.forbidden)
+        rtn.anchors = list(self.anchors)
+        return rtn
+
+    def toArray(self):
+        grid = np.zeros((boardsize, boardsize), dtype=int)
+        for color in range(1, 5):
+            grid[maskToArray(self.tiles[color - 1])] = color
+        return grid
+
+    def placementMask(self, entry, xmin, ymin):
+        """Return the bitboard of entry placed at (xmin, ymin), or None if it sticks off the board."""
+        if (xmin < 0 or ymin < 0 or xmin + entry.width > boardsize
+            or ymin + entry.height > boardsize):
+            return None
+        return Bitboard.entryMasks[(entry.name, entry.orientation)] << (ymin * width + xmin)
+
+    def fits(self, color, entry, xmin, ymin):
+        mask = self.placementMask(entry, xmin, ymin)
+        if mask is None:
+            return False
+        return not (mask & (self.occupied | self.forbidden[color - 1]))
+
+    def legal(self, color, entry, xmin, ymin):
+        mask = self.placementMask(entry, xmin, ymin)
+        if mask is None:
+            return False
+        return (not (mask & (self.occupied | self.forbidden[color - 1]))
+                and bool(mask & self.anchors[color - 1]))
+
+    def isAnchor(self, color, cell):
+        return bool((self.anchors[color - 1] >> cell) & 1)
+
+    def freeMask(self, color):
+        return ~(self.occupied | self.forbidden[color - 1]) & Bitboard.allSquares
+
+    def anchorMask(self, color):
+        return self.anchors[color - 1]
+
+    def place(self, color, entry, xmin, ymin):
+        mask = self.placementMask(entry, xmin, ymin)
+        changes = (self.tiles[color - 1], self.occupied, self.forbidden[color - 1],
+                   tuple(self.anchors))
+        self.tiles[color - 1] |= mask
+        self.occupied |= mask
+        for other in range(1, 5):
+            if other == color:
+                self.deriveMasks(color)
+            else:
+                self.anchors[other - 1] &= ~mask
+        return changes
+
+    def unplace(self, color, changes):
+        self.tiles[color - 1], self.occupied, self.forbidden[color - 1], anchors = changes
+        self.anchors = list(anchors)
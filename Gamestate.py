@@ -2,10 +2,12 @@
 # Contains a class representing a specific state in the game space - turn, hands,
 # board, etc. - and functions useful for setup of gamestates
 
-from copy import deepcopy
 import Pieces
+import Boards
+import Placements
 import BlokusFunctions as bfn
 import sys
+import random
 import numpy as np
 
 def initRefHand():
@@ -60,31 +62,215 @@ def initHand():
     rtn['Z'] = True
     return rtn
 
+# Piece names from largest to smallest. Hands are stored as an int with bit
+# i set while the hand still holds pieceNames[i].
+pieceNames = ("F","I","L","N","P","T","U","V","W","X","Y","Z",
+              "I4", "L4", "N4", "O", "T4",
+              "I3","V3",
+              "Two",
+              "One")
+pieceBits = dict((name, 1 << i) for i, name in enumerate(pieceNames))
+bitNames = dict((bit, name) for name, bit in pieceBits.items())
+fullHand = (1 << len(pieceNames)) - 1
+
+# Scoring, official rules: -1 for each square left in hand, +15 for playing
+# every piece, or +20 if the last piece played was the monomino
+allPlayedBonus = 15
+monominoLastBonus = 20
+
+def handNames(hand):
+    """Return the names of the pieces in hand mask, largest first."""
+    rtn = list()
+    while hand:
+        bit = hand & -hand
+        rtn.append(bitNames[bit])
+        hand ^= bit
+    return rtn
+
+def handScore(hand, lastPlayed):
+    """Return the score of a color holding hand mask whose last piece played was lastPlayed."""
+    if hand == 0:
+        if lastPlayed == "One":
+            return monominoLastBonus
+        return allPlayedBonus
+    return -sum(Pieces.pieceSizes[name] for name in handNames(hand))
+
+def handMask(hand):
+    """Return the int hand mask of a hand dict mapping piece names to booleans."""
+    rtn = 0
+    for name, val in hand.items():
+        if val:
+            rtn |= pieceBits[name]
+    return rtn
+
+# Zobrist keys: a position's key is the xor of a random 64-bit key for each
+# tile on the board, each piece still in a hand, the player to move and the
+# pass count, so a move changes it with a few xors
+def initZobrist():
+    """Return (cells, pieces, turns, passes) random key tables, indexed [color - 1][padded square], [color - 1][name], [color - 1] and [pass count]."""
+    rng = random.Random(20)
+    cells = [[rng.getrandbits(64) for cell in range(Boards.width * Boards.width)]
+             for color in range(4)]
+    pieces = [dict((name, rng.getrandbits(64)) for name in pieceNames)
+              for color in range(4)]
+    turns = [rng.getrandbits(64) for color in range(4)]
+    passes = [rng.getrandbits(64) for count in range(5)]
+    return cells, pieces, turns, passes
+
+zobristCells, zobristPieces, zobristTurns, zobristPasses = initZobrist()
+
+def passKey(passCount):
+    """Return the Zobrist key of a pass count; counts of 4 and up share a key."""
+    return zobristPasses[min(passCount, 4)]
+
 def startCorner(color):
-    """Return a list with the starting corner for the given color."""
+    """Return a set with the key of the starting corner for the given color."""
     # NOTE: At some point this should be changed so play order goes clockwise.
-    corners = list()
-    if color == 1:
-        corners.append(np.array([[-1,0],[-1,0]]))
-    if color == 2:
-         corners.append(np.array([[Gamestate.boardsize, Gamestate.boardsize-1],[-1,0]]))
-    if color == 3:
-        corners.append(np.array([[Gamestate.boardsize, Gamestate.boardsize-1],
-                                 [Gamestate.boardsize, Gamestate.boardsize-1]]))
-    if color == 4:
-       corners.append(np.array([[-1,0],[Gamestate.boardsize, Gamestate.boardsize-1]]))
-    return corners
-
-def initBoard():
-    """Returns an empty board"""
-    board = np.zeros((Gamestate.boardsize,Gamestate.boardsize),dtype=int)
-    return board
-
-class Gamestate:
+    tx, ty = Boards.startTiles[color]
+    x = min(max(tx, 0), Gamestate.boardsize - 1)
+    y = min(max(ty, 0), Gamestate.boardsize - 1)
+    return set([Boards.cornerKey(x, y, tx - x, ty - y)])
+
+def initCornerKeys():
+    """Return corner-set keys for each orientation placed at (0, 0), keyed by (name, orientation).
+
+    Each value is (covered, edges, anchors, byDirection): keys for every
+    direction of the piece's tiles and of the squares edge adjacent to it,
+    keys of the open corners it creates, and its corner tiles grouped by the
+    direction their diagonal points."""
+    rtn = dict()
+    for name, entries in Pieces.orientationTable.items():
+        for entry in entries:
+            cells = set(entry.cells)
+            edges = set()
+            for x, y in entry.cells:
+                for nx, ny in ((x+1, y), (x, y+1), (x-1, y), (x, y-1)):
+                    if (nx, ny) not in cells:
+                        edges.add((nx, ny))
+            covered = [Boards.cellIndex(x, y) * 4 + d for x, y in entry.cells for d in range(4)]
+            edgeKeys = [Boards.cellIndex(x, y) * 4 + d for x, y in edges for d in range(4)]
+            anchors = [Boards.cornerKey(x + dx, y + dy, -dx, -dy) for x, y, dx, dy in entry.corners]
+            byDirection = tuple([(x, y) for x, y, dx, dy in entry.corners if (dx, dy) == diagonal]
+                                for diagonal in Boards.diagonals)
+            rtn[(name, entry.orientation)] = (covered, edgeKeys, anchors, byDirection)
+    return rtn
+
+def initSampleTable():
+    """Return (weights, proposals, tileKeys) for sampling moves piece by piece, as Gamestate.weightedRandomMove does.
+
+    proposals[(name, direction)] lists (entry, x, y) for every corner tile
+    (x, y) of every orientation of the piece whose diagonal points in that
+    direction; weights[name] is the piece's size times the length of those
+    lists, which is the same for every direction. tileKeys[(name,
+    orientation)] are the corner keys its corner tiles cover when placed at
+    (0, 0)."""
+    weights = dict()
+    proposals = dict()
+    tileKeys = dict()
+    for name, entries in Pieces.orientationTable.items():
+        for direction, diagonal in enumerate(Boards.diagonals):
+            proposals[(name, direction)] = tuple((entry, x, y) for entry in entries
+                                                 for x, y, dx, dy in entry.corners
+                                                 if (dx, dy) == diagonal)
+        weights[name] = Pieces.pieceSizes[name] * len(proposals[(name, 0)])
+        for entry in entries:
+            tileKeys[(name, entry.orientation)] = tuple(Boards.cornerKey(x, y, dx, dy)
+                                                        for x, y, dx, dy in entry.corners)
+    return weights, proposals, tileKeys
+
+class MoveCache(object):
+    """The legal moves of one color, as placement IDs indexed by the squares they cover and by piece name."""
+
+    def __init__(self):
+        self.moves = set()
+        self.byCell = dict()
+        self.byPiece = dict()
+
+    def copy(self):
+        """Return an independent copy of this cache."""
+        rtn = MoveCache()
+        rtn.moves = set(self.moves)
+        rtn.byCell = dict((cell, set(moves)) for cell, moves in self.byCell.items())
+        rtn.byPiece = dict((name, set(moves)) for name, moves in self.byPiece.items())
+        return rtn
+
+    def add(self, move):
+        """Add move and return whether it was new."""
+        if move in self.moves:
+            return False
+        placement = Placements.table[move]
+        self.moves.add(move)
+        for cell in placement.cells:
+            self.byCell.setdefault(cell, set()).add(move)
+        self.byPiece.setdefault(placement.name, set()).add(move)
+        return True
+
+    def remove(self, move):
+        """Remove move from the cache."""
+        placement = Placements.table[move]
+        self.moves.remove(move)
+        for cell in placement.cells:
+            self.byCell[cell].remove(move)
+        self.byPiece[placement.name].remove(move)
+
+    def removeCells(self, cells, removed = None):
+        """Remove every move covering one of the padded squares in cells, appending them to removed if given."""
+        for cell in cells:
+            moves = self.byCell.get(cell)
+            if moves:
+                moves = list(moves)
+                for move in moves:
+                    self.remove(move)
+                if removed is not None:
+                    removed.extend(moves)
+
+    def removePiece(self, name, removed = None):
+        """Remove every move of the named piece, appending them to removed if given."""
+        moves = self.byPiece.get(name)
+        if moves:
+            moves = list(moves)
+            for move in moves:
+                self.remove(move)
+            if removed is not None:
+                removed.extend(moves)
+
+class Gamestate(object):
     """A game state in Blokus, with hands, board, turn etc."""
 
-    referenceHand = initRefHand()
-    boardsize = 20
+    # hands: hand mask of each color
+    # corners: set of open corner keys of each color
+    # backend: Boards.Board holding the tiles
+    # lastPlayed: tuple of the name of the piece each color played last
+    # scores: current score of each color, kept up to date as pieces are
+    #     played
+    # moveCaches: MoveCache of each color, or None until first needed
+    # pending: per color, tuple of (squares lost, piece played or None,
+    #     corners gained) changes not yet applied to its MoveCache
+    # shared: bits 0-3 are set while the corner set of color 1-4 is shared
+    #     with another gamestate, bits 4-7 likewise for its MoveCache;
+    #     shared structures are copied before they are changed
+    # exhausted: bit color - 1 is set once color is known never to be able
+    #     to move again - its hand or corner set is empty, or nothing fits.
+    #     Turns skip such colors, each skip counting as a pass.
+    # infeasible: per color, hand mask of pieces that fit nowhere it can
+    #     still reach, and so can never be played
+    # witnesses: per color, dict of piece name to a Placements.Placement
+    #     that fitted when last checked; replaced, never changed in place
+    __slots__ = ('hands', 'corners', 'backend', 'turn', 'passCount', 'lastPlayed',
+                 'scores', 'moveCaches', 'pending', 'shared', 'exhausted',
+                 'infeasible', 'witnesses', 'key')
+
+    boardsize = Boards.boardsize
+    cornerKeys = initCornerKeys()
+    sampleTable = initSampleTable()
+
+    # Proposals weightedRandomMove rejects before falling back to the legal
+    # move cache
+    sampleTries = 32
+
+    # Board backend used for new gamestates; set to Boards.Bitboard to keep
+    # the board as bitboards and build the array only when it is asked for
+    backendType = Boards.ArrayBoard
 
     def __init__(self, blue = 'default', yellow = 'default', red = 'default',
                  green = 'default',
@@ -93,78 +279,109 @@ class Gamestate:
                  rcorners = 'default',
                  gcorners = 'default',
                  board = 'default', turn = 1, passCount = 0,
-                 lastPlayed = 'default'):
+                 lastPlayed = 'default', backend = 'default'):
         """ Initialize a gamestate with given parameters, or a default gamestate if none are provided."""
-        
-        if blue == 'default':
-            self.blue = initHand()
-        else:
-            self.blue = blue
-            
-        if yellow == 'default':
-            self.yellow = initHand()
-        else:
-            self.yellow = yellow
-
-        if red == 'default':
-            self.red = initHand()
-        else:
-            self.red = red
-
-        if green == 'default':
-            self.green = initHand()
-        else:
-            self.green = green
-
-        if bcorners == 'default':
-            self.bcorners = startCorner(1)
-        else:
-            self.bcorners = bcorners
-
-        if ycorners == 'default':
-            self.ycorners = startCorner(2)
-        else:
-            self.ycorners = ycorners
 
-        if rcorners == 'default':
-            self.rcorners = startCorner(3)
+        self.hands = list()
+        for hand in [blue, yellow, red, green]:
+            if hand == 'default':
+                self.hands.append(fullHand)
+            else:
+                self.hands.append(handMask(hand))
+
+        self.corners = list()
+        for color, corners in enumerate([bcorners, ycorners, rcorners, gcorners], 1):
+            if corners == 'default':
+                self.corners.append(startCorner(color))
+            else:
+                self.corners.append(set(corners))
+
+        if backend != 'default':
+            self.backend = backend
+        elif isinstance(board, str):
+            self.backend = Gamestate.backendType()
         else:
-            self.rcorners = rcorners
-
-        if gcorners == 'default':
-            self.gcorners = startCorner(4)
-        else:
-            self.gcorners = gcorners
-
-        if board == 'default':
-            self.board = initBoard()
-        else:
-            self.board = board
+            self.backend = Gamestate.backendType.fromArray(board)
             
         self.turn = turn
         self.passCount = passCount
 
         if lastPlayed == 'default':
-            self.lastPlayed = [None, None, None, None]
+            self.lastPlayed = (None, None, None, None)
         else:
-            self.lastPlayed = lastPlayed
+            self.lastPlayed = tuple(lastPlayed)
+        self.scores = [handScore(self.hands[i], self.lastPlayed[i]) for i in range(4)]
+
+        # Legal moves of each color, generated when first asked for and
+        # then patched after each update
+        self.moveCaches = [None, None, None, None]
+        self.pending = [(), (), (), ()]
+        self.shared = 0
+        self.exhausted = 0
+        self.infeasible = [0, 0, 0, 0]
+        self.witnesses = [dict() for i in range(4)]
+        self.key = self.computeKey()
+
+    def computeKey(self):
+        """Return the Zobrist key of this gamestate, computed from scratch."""
+        key = zobristTurns[self.turn - 1] ^ passKey(self.passCount)
+        board = self.board
+        for y, x in zip(*np.nonzero(board)):
+            key ^= zobristCells[int(board[y, x]) - 1][Boards.cellIndex(int(x), int(y))]
+        for color in range(1, 5):
+            for name in pieceNames:
+                if self.hands[color - 1] & pieceBits[name]:
+                    key ^= zobristPieces[color - 1][name]
+        return key
+
+    def __hash__(self):
+        return self.key
+
+    def __eq__(self, other):
+        """Return true if other is a gamestate with the same board, hands, turn and pass count."""
+        if not isinstance(other, Gamestate) or self.key != other.key:
+            return False
+        return (self.turn == other.turn and self.passCount == other.passCount
+                and self.hands == other.hands
+                and np.array_equal(self.board, other.board))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getstate__(self):
+        """Return what pickling needs: the value of every slot that is set."""
+        return dict((name, getattr(self, name)) for name in Gamestate.__slots__
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def duplicate(self):
-        """Return a deep copy of this gamestate object."""
-        blue = deepcopy(self.blue)
-        yellow = deepcopy(self.yellow)
-        red = deepcopy(self.red)
-        green = deepcopy(self.green)
-        bcorners = deepcopy(self.bcorners)
-        ycorners = deepcopy(self.ycorners)
-        rcorners = deepcopy(self.rcorners)
-        gcorners = deepcopy(self.gcorners)
-        board = self.board.copy()
-        turn = self.turn
-        passCount = self.passCount
-        lastPlayed = deepcopy(self.lastPlayed)
-        return Gamestate(blue, yellow, red, green, bcorners, ycorners, rcorners,
-                         gcorners, board, turn, passCount, lastPlayed)
+        """Return a copy of this gamestate that can be updated independently."""
+        rtn = Gamestate.__new__(Gamestate)
+        rtn.hands = list(self.hands)
+        rtn.corners = list(self.corners)
+        rtn.backend = self.backend.copy()
+        rtn.turn = self.turn
+        rtn.passCount = self.passCount
+        rtn.lastPlayed = self.lastPlayed
+        rtn.scores = list(self.scores)
+        rtn.moveCaches = list(self.moveCaches)
+        rtn.pending = list(self.pending)
+        rtn.exhausted = self.exhausted
+        rtn.infeasible = list(self.infeasible)
+        rtn.witnesses = list(self.witnesses)
+        rtn.key = self.key
+
+        # Corner sets and move caches are now shared copy-on-write
+        self.shared = rtn.shared = 0xff
+        return rtn
+
+    @property
+    def board(self):
+        """The board as a boardsize x boardsize int array of colors."""
+        return self.backend.toArray()
 
     def equals(self, other):
         """Return true if this gamestate has the same board/turn as other, false otherwise."""
@@ -174,384 +391,552 @@ class Gamestate:
     
     def update(self, move):
         """Update gamestate with provided move if legal, else return False"""
-        if len(move) != 4: # Then move is a pass
-            self.setLastPlayed(None, self.turn)
-            self.passCount = self.passCount + 1
-            self.advanceTurn()
+        placement = self.movePlacement(move)
+        if placement is None:
+            return False
+        if placement == Placements.PASS:
+            self.passTurn()
             return
-        
-        name = move[0]
         color = self.turn
-        
-        # If player doesn't have piece, move is illegal
-        if not self.getHand(color)[name]:
-            return False
-        piece = Gamestate.referenceHand[name]
-
-        # Set piece to correct orientation and location
-        orientation = move[1]
-        piece.setOrientation(orientation)
-
-        move_xmin = move[2]
-        move_ymin = move[3]
-        piece_extremes = bfn.findExtremes(piece.shape)
-        piece_xmin, piece_ymin = piece_extremes[0], piece_extremes[2]
-        xdif = move_xmin - piece_xmin
-        ydif = move_ymin - piece_ymin
-        piece.translate(xdif, ydif)
-
-        # Check if move is legal
-        if not self.moveCheck(piece):
-            return False
 
         # Set appropriate squares to player color
-        self.colorSet(piece.shape, self.turn)
+        self.backend.place(color, placement.entry, placement.xmin, placement.ymin)
 
-        # Update corner list
-        self.updateCorners(self.turn, piece.corners)
+        # Update corner sets
+        newCorners, lostCorners = self.updateCorners(color, placement)
 
         # Remove piece played from hand
-        self.getHand(self.turn)[name] = False
+        self.removeFromHand(color, placement)
 
-        # Reset pass count
-        self.passCount = 0
-    
-        # Update lastPlayed
-        self.setLastPlayed(name, self.turn)
-        
-        # Advance turn
+        # Queue changes to cached legal moves
+        self.updateMoveCaches(color, placement, newCorners)
+
+        # Reset pass count, update lastPlayed and advance turn
+        self.setPassCount(0)
+        self.setLastPlayed(placement.name, color)
         self.advanceTurn()
-        
-    def moveCheck(self, piece):
-        """Return whether a move is legal."""
-        
-        # Check if one of piece's corners matches an open corner on the board
-        bcorners = self.getCorners(self.turn)
-        pcorners = piece.corners
-        diagonal = False
-        for cur in bfn.splitCornerArray(pcorners):
-            inv = np.array([[cur[0,1],cur[0,0]],[cur[1,1],cur[1,0]]])
-            for j in range(0, len(bcorners)):
-                if np.array_equal(bcorners[j],inv):
-                    diagonal = True
-                    break
-            if diagonal:
-                break
 
-        if not diagonal:
+    def apply(self, move):
+        """Make move if legal and return a record undo can take it back with, else return False."""
+        record = (self.turn, self.passCount, self.lastPlayed, self.exhausted, self.key)
+        feasibility = (list(self.infeasible), list(self.witnesses))
+        placement = self.movePlacement(move)
+        if placement is None:
             return False
-
-        # Make sure piece does not conflict with anything already on
-        # the board
-        if not self.moveConflicts(piece):
-            return True
-        return False
-
-    def moveConflicts(self, p):
-        """Return whether a move conflicts with (overlaps or is edge adjacent to) pieces on board."""
-
+        if placement == Placements.PASS:
+            self.passTurn()
+            return record + (None,)
         color = self.turn
-        
-        # This dict with string keys will have values that are either
-        # 2x1 arrays (for points to check, surrounding each tile in proposed
-        # move) or False (if the points are off the board or also in the
-        # proposed move)
-        nears = dict()
-
-        # Iterate through each tile in the proposed move
-        for i in range(0, p.size):
-            
-            x = p.shape[0,i]
-            y = p.shape[1,i]
-
-            # If point is off board, conflict
-            if x < 0 or y < 0 or x >= Gamestate.boardsize or y >= Gamestate.boardsize:
-                return True
-
-            # If tile is already occupied, there is a conflict
-            if self.board[y,x] != 0:
-                return True
-
-            # Reset coordinates
-            nears['e'] = False
-            nears['s'] = False
-            nears['w'] = False
-            nears['n'] = False
 
-            # Change 'nears' to appropriate coordinates where they exist
-            if x < (Gamestate.boardsize - 1):
-                nears['e'] = np.array([[x+1],[y]])
+        # Bring every color's legal moves up to date, building any not
+        # cached yet, so that the changes this move makes to them can be
+        # recorded and undone. A cache built after the record would have to
+        # be dropped by undo, and rebuilt after every sibling move
+        for i in range(1, 5):
+            if not self.exhausted & (1 << (i - 1)):
+                self.legalMoves(i)
+
+        boardChanges = self.backend.place(color, placement.entry, placement.xmin, placement.ymin)
+        newCorners, lostCorners = self.updateCorners(color, placement)
+        score = self.scores[color - 1]
+        self.removeFromHand(color, placement)
+
+        # Patch cached legal moves now, recording (color, removed, added)
+        # for each color; removed is None if the color had no cache
+        cacheChanges = list()
+        for i in range(1, 5):
+            if self.moveCaches[i - 1] is None:
+                cacheChanges.append((i, None, None))
+                continue
+            removed = list()
+            added = list()
+            if i == color:
+                self.patchMoveCache(i, placement.cells + placement.edges,
+                                    [placement.name], newCorners, removed, added)
+            else:
+                self.patchMoveCache(i, placement.cells, [], [], removed, added)
+            cacheChanges.append((i, removed, added))
+
+        self.setPassCount(0)
+        self.setLastPlayed(placement.name, color)
+        self.advanceTurn()
+        return record + ((placement, boardChanges, newCorners, lostCorners, score, cacheChanges,
+                          feasibility),)
+
+    def undo(self, record):
+        """Take back the most recent move made with apply, given the record it returned."""
+        turn, passCount, lastPlayed, exhausted, key, changes = record
+        if changes is not None:
+            (placement, boardChanges, newCorners, lostCorners, score, cacheChanges,
+             feasibility) = changes
+            self.backend.unplace(turn, boardChanges)
+            corners = self.ownCorners(turn)
+            for corner in newCorners:
+                corners.discard(corner)
+            for i, corner in lostCorners:
+                self.ownCorners(i).add(corner)
+            self.hands[turn - 1] |= pieceBits[placement.name]
+            self.scores[turn - 1] = score
+            self.infeasible, self.witnesses = feasibility
+            for i, removed, added in cacheChanges:
+                if removed is None:
+                    # Any cache built since describes the later position
+                    self.moveCaches[i - 1] = None
+                    self.pending[i - 1] = ()
+                    continue
+                cache = self.ownMoveCache(i)
+                for move in added:
+                    cache.remove(move)
+                for move in removed:
+                    cache.add(move)
+        self.turn = turn
+        self.passCount = passCount
+        self.lastPlayed = lastPlayed
+        self.exhausted = exhausted
+        self.key = key
+
+    def passTurn(self):
+        """Pass for the current player."""
+        self.setLastPlayed(None, self.turn)
+        self.setPassCount(self.passCount + 1)
+        self.advanceTurn()
 
-            if y < (Gamestate.boardsize - 1):
-                nears['s'] = np.array([[x],[y+1]])
+    def setPassCount(self, passCount):
+        """Set pass count, keeping the Zobrist key up to date."""
+        self.key ^= passKey(self.passCount) ^ passKey(passCount)
+        self.passCount = passCount
 
-            if x > 0:
-                nears['w'] = np.array([[x-1],[y]])
+    def removeFromHand(self, color, placement):
+        """Take the piece of placement out of color's hand, updating its score and the Zobrist key."""
+        hand = self.hands[color - 1] & ~pieceBits[placement.name]
+        self.hands[color - 1] = hand
+        if hand == 0:
+            if placement.name == "One":
+                self.scores[color - 1] = monominoLastBonus
+            else:
+                self.scores[color - 1] = allPlayedBonus
+        else:
+            self.scores[color - 1] += placement.size
+        self.updateKey(color, placement)
+
+    def updateKey(self, color, placement):
+        """Xor the tiles of placement, and the piece leaving color's hand, into the Zobrist key."""
+        key = self.key ^ zobristPieces[color - 1][placement.name]
+        cells = zobristCells[color - 1]
+        for cell in placement.cells:
+            key ^= cells[cell]
+        self.key = key
+
+    def movePlacement(self, move):
+        """Return Placements.PASS if move is a pass, its Placement if it is legal for the current player, else None.
+
+        Move may be a placement ID or a (name, orientation, xmin, ymin) tuple."""
+        move = Placements.moveId(move)
+        if move is None or move == Placements.PASS:
+            return move
+        placement = Placements.table[move]
 
-            if y > 0:
-                nears['n'] = np.array([[x],[y-1]])
+        # If player doesn't have piece, move is illegal
+        if not self.hands[self.turn - 1] & pieceBits[placement.name]:
+            return None
 
-            # Disregard coordinates that are in the move itself
-            for dir, coord in nears.items():
-                if coord is not False:
-                    for j in range(0, p.size):
-                        if np.array_equal(coord,p.shape[:,j].reshape(2,1)):
-                            coord = False
+        # Check if move is legal
+        if not self.moveCheck(placement):
+            return None
+        return placement
 
-            # If any laterally adjacent tiles are player color, move is invalid
-            for dir in ['e', 's', 'n', 'w']:
-                if nears[dir] is not False:
-                    if self.board[nears[dir][1,0]][nears[dir][0,0]] == color: 
-                        return True
+    def moveCheck(self, placement):
+        """Return whether placement is legal for the current player."""
+        if self.moveCaches[self.turn - 1] is not None:
+            return placement.id in self.legalMoves(self.turn).moves
+        return self.backend.legal(self.turn, placement.entry, placement.xmin, placement.ymin)
 
-        return False
+    def moveConflicts(self, entry, xmin, ymin):
+        """Return whether a move conflicts with (overlaps or is edge adjacent to) pieces on board."""
+        return not self.backend.fits(self.turn, entry, xmin, ymin)
         
     def advanceTurn(self):
-        """Advance turn value to next player."""
+        """Advance turn value to next player, passing for players who can never move again."""
+        self.nextTurn()
+        skipped = 0
+        while skipped < 4 and self.isExhausted(self.turn):
+            self.setPassCount(self.passCount + 1)
+            self.nextTurn()
+            skipped = skipped + 1
+
+    def nextTurn(self):
+        """Advance turn value to the next color in order."""
+        self.key ^= zobristTurns[self.turn - 1]
         self.turn = self.turn + 1
         if self.turn == 5:
             self.turn = 1
+        self.key ^= zobristTurns[self.turn - 1]
+
+    def isExhausted(self, color):
+        """Return true if color can never move again, looking for a legal move if not yet known."""
+        bit = 1 << (color - 1)
+        if self.exhausted & bit:
+            return True
+
+        # Pieces and corners are only ever lost, so a color with no legal
+        # move now never has one again. A move cache is only read if there
+        # is one already; building it is left until moves are listed
+        if self.hands[color - 1] == 0 or len(self.corners[color - 1]) == 0:
+            exhausted = True
+        elif self.moveCaches[color - 1] is not None:
+            exhausted = len(self.legalMoves(color).moves) == 0
+        else:
+            self.refreshFeasibility(color)
+            exhausted = self.findFirstMove(color) is None
+        if exhausted:
+            self.exhausted |= bit
+        return exhausted
 
     def getHand(self, color):
-        """Return the hand corresponding to provided color."""
-        if color == 1:
-            return self.blue
-        if color == 2:
-            return self.yellow
-        if color == 3:
-            return self.red
-        if color == 4:
-            return self.green
+        """Return the hand corresponding to provided color as a dict of piece names to booleans."""
+        mask = self.hands[color - 1]
+        return dict((name, bool(mask & bit)) for name, bit in pieceBits.items())
 
     def sortedHand(self, color):
-        """Return the hand corresponding to provided color as a list sorted by piece size."""
-        rtn = list()
-        hand = self.getHand(color)
-        sortednames = ["F","I","L","N","P","T","U","V","W","X","Y","Z",
-                       "I4", "L4", "N4", "O", "T4",
-                       "I3","V3",
-                       "Two",
-                       "One"]
-        for name in sortednames:
-            if hand[name]:
-                rtn.append(Gamestate.referenceHand[name])
-        return rtn
+        """Return the names of the pieces in the hand corresponding to provided color, sorted by piece size."""
+        return handNames(self.hands[color - 1])
 
     def getCorners(self, color):
-        """Return the corner list corresponding to provided color."""
-        if color == 1:
-            return self.bcorners
-        if color == 2:
-            return self.ycorners
-        if color == 3:
-            return self.rcorners
-        if color == 4:
-            return self.gcorners
-
-    def updateCorners(self, color, corners):
-        """Update color's corner list with provided 2x2n corner matrix."""
-        oldList = self.getCorners(color)
-        for cur in bfn.splitCornerArray(corners):
-            inv = np.array([[cur[0,1],cur[0,0]],[cur[1,1],cur[1,0]]])
-            obliterated = False
-            for j in range(0, len(oldList)):
-                if np.array_equal(oldList[j],inv):
-                    del oldList[j]
-                    obliterated = True
+        """Return the corner set corresponding to provided color."""
+        return self.corners[color - 1]
+
+    def ownCorners(self, color):
+        """Return color's corner set for changing, copying it first if it is shared."""
+        bit = 1 << (color - 1)
+        if self.shared & bit:
+            self.corners[color - 1] = set(self.corners[color - 1])
+            self.shared &= ~bit
+        return self.corners[color - 1]
+
+    def ownMoveCache(self, color):
+        """Return color's MoveCache (or None) for changing, copying it first if it is shared."""
+        bit = 1 << (color + 3)
+        if self.shared & bit:
+            if self.moveCaches[color - 1] is not None:
+                self.moveCaches[color - 1] = self.moveCaches[color - 1].copy()
+            self.shared &= ~bit
+        return self.moveCaches[color - 1]
+
+    def updateCorners(self, color, placement):
+        """Update corner sets after color has made placement.
+
+        Return (added, lost): the keys added to color's set, and (color, key)
+        for each key removed from any set."""
+        covered, edges, anchors, byDirection = Gamestate.cornerKeys[(placement.name, placement.orientation)]
+        shift = 4 * (placement.ymin * Boards.width + placement.xmin)
+
+        # Corners on the piece's tiles are gone for everyone, and corners
+        # edge adjacent to it are gone for its own color
+        lost = list()
+        for i in range(1, 5):
+            gone = [key + shift for key in covered if key + shift in self.corners[i - 1]]
+            if gone:
+                corners = self.ownCorners(i)
+                for key in gone:
+                    corners.discard(key)
+                    lost.append((i, key))
+        corners = self.ownCorners(color)
+        for key in edges:
+            if key + shift in corners:
+                corners.discard(key + shift)
+                lost.append((color, key + shift))
+
+        # Add the piece's own corners that are still open
+        added = list()
+        for key in anchors:
+            if self.backend.isAnchor(color, (key + shift) >> 2):
+                corners.add(key + shift)
+                added.append(key + shift)
+        return added, lost
+
+    def legalMoves(self, color):
+        """Return the MoveCache holding color's legal moves, generating or patching it if needed."""
+        cache = self.moveCaches[color - 1]
+        if cache is None:
+            cache = MoveCache()
+            self.refreshFeasibility(color)
+            for name in handNames(self.hands[color - 1] & ~self.infeasible[color - 1]):
+                for entry in Pieces.orientationTable[name]:
+                    for move in self.findPieceMoves(entry, color):
+                        cache.add(move)
+            self.moveCaches[color - 1] = cache
+            self.shared &= ~(1 << (color + 3))
+            self.pending[color - 1] = ()
+        elif self.pending[color - 1]:
+            cells = list()
+            names = list()
+            newCorners = list()
+            for lost, name, added in self.pending[color - 1]:
+                cells.extend(lost)
+                if name is not None:
+                    names.append(name)
+                newCorners.extend(added)
+            self.pending[color - 1] = ()
+            cache = self.patchMoveCache(color, cells, names, newCorners)
+        return cache
+
+    def patchMoveCache(self, color, cells, names, newCorners, removed = None, added = None):
+        """Remove color's cached moves covering cells or using pieces in names, add moves through newCorners, and return the cache.
+
+        Removed and added moves are appended to removed and added if given."""
+        cache = self.moveCaches[color - 1]
+        if not (names or newCorners or any(cache.byCell.get(cell) for cell in cells)):
+            return cache
+        cache = self.ownMoveCache(color)
+        cache.removeCells(cells, removed)
+        for name in names:
+            cache.removePiece(name, removed)
+
+        # Any newly legal move has to use one of the new corners still open
+        corners = self.getCorners(color)
+        newCorners = [key for key in newCorners if key in corners]
+        if newCorners:
+            self.refreshFeasibility(color)
+            for name in handNames(self.hands[color - 1] & ~self.infeasible[color - 1]):
+                for entry in Pieces.orientationTable[name]:
+                    for move in self.findPieceMoves(entry, color, newCorners):
+                        if cache.add(move):
+                            if added is not None:
+                                added.append(move)
+        return cache
+
+    def refreshFeasibility(self, color):
+        """Make sure each piece in color's hand has a witness placement that fits, or mark it infeasible.
+
+        A piece that no longer fits where its witness was is looked for
+        anywhere in the free squares connected, through edges or corners, to
+        color's anchors. Color's own pieces can only ever go there, and
+        free squares are only ever lost, so a piece found not to fit there
+        never will."""
+        witnesses = self.witnesses[color - 1]
+        infeasible = self.infeasible[color - 1]
+        changed = None
+        reach = None
+        for name in handNames(self.hands[color - 1] & ~infeasible):
+            witness = witnesses.get(name)
+            if (witness is not None
+                and self.backend.fits(color, witness.entry, witness.xmin, witness.ymin)):
+                continue
+            if reach is None:
+                reach = Boards.floodFill(self.backend.anchorMask(color),
+                                         self.backend.freeMask(color))
+            if changed is None:
+                changed = dict(witnesses)
+            changed.pop(name, None)
+            for placement in Placements.byName[name]:
+                if not placement.mask & ~reach:
+                    changed[name] = placement
                     break
-            if -1 in cur or Gamestate.boardsize in cur:
+            else:
+                infeasible |= pieceBits[name]
+        if changed is not None:
+            self.witnesses[color - 1] = changed
+        self.infeasible[color - 1] = infeasible
+
+    def updateMoveCaches(self, color, placement, newCorners):
+        """Queue the changes to cached legal moves after color has made placement.
+
+        Changes are applied by legalMoves the next time a color's moves are
+        needed, so a duplicated gamestate never copies or patches caches it
+        does not read."""
+        for i in range(1, 5):
+            if self.moveCaches[i - 1] is None:
                 continue
-            if not obliterated:
-                oldList.append(cur.copy())
+            if i == color:
+                # Its own color also loses the squares edge adjacent to it,
+                # every placement of the piece just played, and gains moves
+                # through its new corners
+                change = (placement.cells + placement.edges, placement.name, tuple(newCorners))
+            else:
+                # Nobody else can use the piece's tiles any more
+                change = (placement.cells, None, ())
+            self.pending[i - 1] = self.pending[i - 1] + (change,)
 
     def setLastPlayed(self, name, color):
         """Set lastPlayed entry corresponding to color to provided piece name."""
-        for i in range(1,5):
-            if color == i:
-                self.lastPlayed[i-1] = name
+        lastPlayed = list(self.lastPlayed)
+        lastPlayed[color - 1] = name
+        self.lastPlayed = tuple(lastPlayed)
         
-    def colorSet(self, coords, color):
-        """Change coordinates in 2xn coordinate matrix to provided color."""
-        if not (color in range(1,5)):
-            return False
-        for i in range(coords[0].size):
-            if self.board[coords[1,i]][coords[0,i]] != 0:
-                return False
-            self.board[coords[1,i]][coords[0,i]] = color
-        return True
-
     def listMoves(self):
-        """Get list of possible moves for current player."""
+        """Get list of possible moves for current player, as placement IDs."""
         rtn = list()
 
-        hand = self.getHand(self.turn)
         corners = self.getCorners(self.turn)
 
         # If no corners or no pieces in hand, no moves are possible
-        if not (True in hand.values()) or len(corners) == 0:
+        if self.hands[self.turn - 1] == 0 or len(corners) == 0:
             return rtn
 
-        # For each piece, find list of moves for each orientation
-        # with findPieceMoves
-        sortedHand = self.sortedHand(self.turn)
-        for piece in sortedHand:
-            rtn.extend(self.findPieceMoves(piece))
-
-            if piece.r90 and piece.r180:
-                for i in range(3):
-                    piece.rotate(1)
-                    rtn.extend(self.findPieceMoves(piece))
-            elif piece.r90 and not piece.r180:
-                piece.rotate(1)
-                rtn.extend(self.findPieceMoves(piece))
-                
-            if piece.chiral:
-                piece.flipV()
-                rtn.extend(self.findPieceMoves(piece))
-
-                if piece.r90 and piece.r180:
-                    for i in range(3):
-                        piece.rotate(1)
-                        rtn.extend(self.findPieceMoves(piece))
-                elif piece.r90 and not piece.r180:
-                    piece.rotate(1)
-                    rtn.extend(self.findPieceMoves(piece))
-
-        # Finally, add 'pass!' which is always a valid move
-        rtn.append('pass!')
+        # Collect cached moves piece by piece, largest pieces first
+        cache = self.legalMoves(self.turn)
+        for name in handNames(self.hands[self.turn - 1] & ~self.infeasible[self.turn - 1]):
+            moves = cache.byPiece.get(name)
+            if moves:
+                rtn.extend(moves)
+
+        # Finally, add a pass, which is always a valid move
+        rtn.append(Placements.PASS)
         return rtn
 
-    def findPieceMoves(self, p):
-        """Return list of possible moves for piece p in current orientation."""
-        
+    def findPieceMoves(self, entry, color = None, corners = None):
+        """Return list of possible moves, as placement IDs, for the piece in orientation entry.
+
+        Moves are for color (default: current player) and use one of corners
+        (default: all of color's open corners)."""
+
+        if color is None:
+            color = self.turn
+        if corners is None:
+            corners = self.getCorners(color)
+
         rtn = list()
-        bcorners = self.getCorners(self.turn)
-        piece_extremes = bfn.findExtremes(p.shape)
-        piece_xmin, piece_ymin = piece_extremes[0], piece_extremes[2]
+        byDirection = Gamestate.cornerKeys[(entry.name, entry.orientation)][3]
+        xmax = Gamestate.boardsize - entry.width
+        ymax = Gamestate.boardsize - entry.height
+
+        # A placement touching several open corners is reached once from
+        # each of them, so remember the ones already checked
+        seen = set()
         
-        # For each corner pc on the piece...
-        pcorners = p.corners
-        for pc in bfn.splitCornerArray(pcorners):
-
-            # For each corner bc on the board...
-            for bc in bcorners:
-
-                inv = np.array([[bc[0,1],bc[0,0]],[bc[1,1],bc[1,0]]])
-                
-                # Check if orientation of pc matches flipped bc:
-                if ((pc[0,1] - pc[0,0]) == (inv[0,1] - inv[0,0]) and
-                    (pc[1,1] - pc[1,0]) == (inv[1,1] - inv[1,0])):
-
-                    # Move piece to matching location
-                    xdif = inv[0,0] - pc[0,0]
-                    ydif = inv[1,0] - pc[1,0]
-                    p.translate(xdif, ydif)
-                    piece_xmin += xdif
-                    piece_ymin += ydif
+        # For each open corner on the board...
+        for key in corners:
+            ax, ay = Boards.cornerSquare(key)
+
+            # For each piece corner pointing the same way, move that corner
+            # onto the open square
+            for x, y in byDirection[key & 3]:
+                xmin = ax - x
+                ymin = ay - y
+                if xmin < 0 or ymin < 0 or xmin > xmax or ymin > ymax:
+                    continue
+                move = Placements.placementId(entry, xmin, ymin)
+                if move in seen:
+                    continue
+                seen.add(move)
                     
-                    # Now check if move is appropriate
-                    if not self.moveConflicts(p):
-                        rtn.append((p.name, p.orientation, piece_xmin, piece_ymin))
+                # Now check if move is appropriate
+                if self.backend.fits(color, entry, xmin, ymin):
+                    rtn.append(move)
 
         return rtn
 
+    def findFirstMove(self, color):
+        """Return the first legal move found for color, as a placement ID, or None if it has none, without building its move cache.
+
+        Pieces are tried largest first, as placements are in findPieceMoves."""
+        corners = self.getCorners(color)
+        for name in handNames(self.hands[color - 1] & ~self.infeasible[color - 1]):
+            for entry in Pieces.orientationTable[name]:
+                byDirection = Gamestate.cornerKeys[(entry.name, entry.orientation)][3]
+                xmax = Gamestate.boardsize - entry.width
+                ymax = Gamestate.boardsize - entry.height
+                for key in corners:
+                    ax, ay = Boards.cornerSquare(key)
+                    for x, y in byDirection[key & 3]:
+                        xmin = ax - x
+                        ymin = ay - y
+                        if xmin < 0 or ymin < 0 or xmin > xmax or ymin > ymax:
+                            continue
+                        if self.backend.fits(color, entry, xmin, ymin):
+                            return Placements.placementId(entry, xmin, ymin)
+        return None
+
+    def bruteForceMoves(self, color = None):
+        """Return the set of legal moves for color (default: current player) found by testing every placement on the board.
+
+        Much slower than listMoves; for checking move generation."""
+        if color is None:
+            color = self.turn
+        rtn = set()
+        hand = self.hands[color - 1]
+        for placement in Placements.table[1:]:
+            if (hand & pieceBits[placement.name]
+                and self.backend.legal(color, placement.entry, placement.xmin, placement.ymin)):
+                rtn.add(placement.id)
+        return rtn
+
     def canMove(self):
         """Return the first legal move found."""
-        hand = self.getHand(self.turn)
         corners = self.getCorners(self.turn)
 
         # If no corners or no pieces in hand, no moves are possible
-        if not (True in hand.values()) or len(corners) == 0:
+        if self.hands[self.turn - 1] == 0 or len(corners) == 0:
             return False
 
-        # For each piece, find list of moves for each orientation
-        # with findPieceMoves
-        sortedHand = self.sortedHand(self.turn)
-        for piece in sortedHand:
-            canFindPieceMoves = self.canFindPieceMoves(piece)
-            if not canFindPieceMoves == False:
-                return canFindPieceMoves
-
-            if piece.r90 and piece.r180:
-                for i in range(3):
-                    piece.rotate(1)
-                    canFindPieceMoves = self.canFindPieceMoves(piece)
-                    if not canFindPieceMoves == False:
-                        return canFindPieceMoves                  
-            elif piece.r90 and not piece.r180:
-                piece.rotate(1)
-                canFindPieceMoves = self.canFindPieceMoves(piece)
-                if not canFindPieceMoves == False:
-                    return canFindPieceMoves
-                
-            if piece.chiral:
-                piece.flipV()
-                canFindPieceMoves = self.canFindPieceMoves(piece)
-                if not canFindPieceMoves == False:
-                    return canFindPieceMoves
-                if piece.r90 and piece.r180:
-                    for i in range(3):
-                        piece.rotate(1)
-                        canFindPieceMoves = self.canFindPieceMoves(piece)
-                        if not canFindPieceMoves == False:
-                            return canFindPieceMoves
-                elif piece.r90 and not piece.r180:
-                    piece.rotate(1)
-                    canFindPieceMoves = self.canFindPieceMoves(piece)
-                    if not canFindPieceMoves == False:
-                        return canFindPieceMoves
+        # Return a cached move of the largest piece that has one
+        cache = self.legalMoves(self.turn)
+        for name in handNames(self.hands[self.turn - 1] & ~self.infeasible[self.turn - 1]):
+            moves = cache.byPiece.get(name)
+            if moves:
+                return min(moves)
         return False
 
-    def canFindPieceMoves(self, p):
-        """Return first legal move found for piece p in current orientation."""
-
-        bcorners = self.getCorners(self.turn)
-        piece_extremes = bfn.findExtremes(p.shape)
-        piece_xmin, piece_ymin = piece_extremes[0], piece_extremes[2]
-        
-        # For each corner pc on the piece...
-        pcorners = p.corners
-        for pc in bfn.splitCornerArray(pcorners):
-
-            # For each corner bc on the board...
-            for bc in bcorners:
-
-                inv = np.array([[bc[0,1],bc[0,0]],[bc[1,1],bc[1,0]]])
-                
-                # Check if orientation of pc matches flipped bc:
-                if ((pc[0,1] - pc[0,0]) == (inv[0,1] - inv[0,0]) and
-                    (pc[1,1] - pc[1,0]) == (inv[1,1] - inv[1,0])):
-
-                    # Move piece to matching location
-                    xdif = inv[0,0] - pc[0,0]
-                    ydif = inv[1,0] - pc[1,0]
-                    p.translate(xdif, ydif)
-                    piece_xmin += xdif
-                    piece_ymin += ydif
-                    
-                    # Now check if move is appropriate
-                    if not self.moveConflicts(p):
-                        return (p.name, p.orientation, piece_xmin, piece_ymin) 
+    def weightedRandomMove(self):
+        """Return a random legal move for the current player weighted by piece size, as Players.weightedRandomMove does, or PASS if nothing fits.
 
-        return False
+        Moves are drawn by rejection without listing them: pick a piece in
+        proportion to its weight (see initSampleTable), an open corner, and a
+        corner tile of one of its orientations pointing the same way to put
+        on it. Each legal placement is accepted only from the lowest open
+        corner key it covers, so every one is proposed equally often per
+        square. After sampleTries rejections, draw from the cached legal
+        moves instead."""
+        color = self.turn
+        corners = self.getCorners(color)
+        hand = self.hands[color - 1] & ~self.infeasible[color - 1]
+        if hand == 0 or len(corners) == 0:
+            return Placements.PASS
+
+        weights, proposals, tileKeys = Gamestate.sampleTable
+        names = handNames(hand)
+        total = sum(weights[name] for name in names)
+        keys = tuple(corners)
+        for i in range(Gamestate.sampleTries):
+            draw = random.randrange(total)
+            for name in names:
+                draw = draw - weights[name]
+                if draw < 0:
+                    break
+            key = random.choice(keys)
+            entry, x, y = random.choice(proposals[(name, key & 3)])
+            ax, ay = Boards.cornerSquare(key)
+            xmin = ax - x
+            ymin = ay - y
+            if not self.backend.fits(color, entry, xmin, ymin):
+                continue
+            shift = 4 * (ymin * Boards.width + xmin)
+            if min(tileKey + shift for tileKey in tileKeys[(name, entry.orientation)]
+                   if tileKey + shift in corners) == key:
+                return Placements.placementId(entry, xmin, ymin)
+
+        # Most of what was proposed did not fit, so take the legal moves
+        cache = self.legalMoves(color)
+        sizes = [(Pieces.pieceSizes[name] * len(cache.byPiece.get(name, ())), name)
+                 for name in handNames(self.hands[color - 1])]
+        total = sum(size for size, name in sizes)
+        if total == 0:
+            return Placements.PASS
+        draw = random.randrange(total)
+        for size, name in sizes:
+            draw = draw - size
+            if draw < 0:
+                return random.choice(list(cache.byPiece[name]))
 
     def isTerminal(self):
-        """Return true if gamestate is terminal (four consecutive passes), false otherwise."""
-        if self.passCount >= 4:
+        """Return true if gamestate is terminal (four consecutive passes, or no player can move again), false otherwise."""
+        if self.passCount >= 4 or self.exhausted == 0xf:
             return True
         return False
 
     def getScores(self):
         """Return list of scores."""
-        scores = [0,0,0,0]
-        for i in range(1,5):
-            hand = self.getHand(i)
-            for name, val in hand.items():
-                if val:
-                    scores[i-1] = scores[i-1] - Gamestate.referenceHand[name].size
-            if not (True in hand) and self.lastPlayed[i-1]:
-                scores[i-1] = scores[i-1] - 5
-        return scores
+        return list(self.scores)
         
     def printScores(self):
         """Print current scores."""
@@ -582,6 +967,6 @@ class Gamestate:
     def printSortedHand(self, i):
         """Print a player's hand sorted by piece size."""
         sortedhand = self.sortedHand(i)
-        for p in sortedhand:
-            sys.stdout.write(p.name + ' ')
+        for name in sortedhand:
+            sys.stdout.write(name + ' ')
         sys.stdout.write("\n")
@@ -10,10 +10,6 @@ import numpy as np
 class HumanPlayer(Players.Player):
     """Human player class."""
     
-    def __init__(self, color):
-        self.color = color
-        self.referenceHand = Gamestate.initRefHand()
-
     def getMove(self, update):
         """When provided an updated gamestate, prompt player for their move."""
 
@@ -36,7 +32,7 @@ class HumanPlayer(Players.Player):
                     return list()
                 while not currHand[name]:
                     name = raw_input("You don't have that piece! Piece to play:")
-                coords = np.zeros((2,self.referenceHand[name].size), dtype = int)
+                coords = np.zeros((2,Pieces.pieceSizes[name]), dtype = int)
 
                 for i in range(0,coords[0].size):
                     gotcoordinate = False
@@ -54,8 +50,7 @@ class HumanPlayer(Players.Player):
 
                 # Check if coordinates match piece claimed, & convert to
                 # (piece, orientation, location) form
-                piece = self.referenceHand[name]
-                piece_orientation = piece.matchingOrientation(coords)
+                piece_orientation = Pieces.matchingOrientation(name, coords)
                 if piece_orientation == -1:
                     print("Those coordinates do not match that piece's shape")
                     continue
@@ -5,76 +5,161 @@ import Pieces
 import Gamestate
 import Players
 import MCTree
+import Rollouts
+import SearchBudget
+import Placements
 import BlokusFunctions as bfn
 import numpy as np
-import time
+import multiprocessing
+import random
+import threading
+import traceback
 import cPickle as pickle
+
+# log(n) by number of playouts n, with log(0) taken as 0; grown as needed
+logTable = np.log(np.maximum(np.arange(1024), 1))
+
+def logPlayouts(n):
+    """Return log(n) for n playouts (0 for none) from logTable, growing it if n is past its end."""
+    global logTable
+    if n >= len(logTable):
+        logTable = np.log(np.maximum(np.arange(2 * n), 1))
+    return logTable[n]
     
 class monteCarloPlayer(Players.AIPlayer):
+
+    # Whether to keep running Monte Carlo iterations from current in a
+    # background thread between moves, until getMove is called again.
+    # Only helps when the other players think outside this process, since
+    # the thread shares the interpreter lock with them otherwise. It stops
+    # early at the budget's node or memory limit, if it has one
+    ponder = False
+
+    # Exploration constant c in the UCB of selection (see ucbMove);
+    # sqrt(2) is UCB1
+    exploration = np.sqrt(2)
+
+    def __init__(self, color, budget = None):
+        # Search budget per move, one per player so searches side by side
+        # keep their own counts; a MCTS iteration takes tens of
+        # milliseconds, so by default the clock is read before each one
+        if budget is None:
+            budget = SearchBudget.SearchBudget(milliseconds = 30000, checkEvery = 1)
+        Players.AIPlayer.__init__(self, color, budget)
+
     def getMove(self, update):
         """Prompted with gamestate, return move chosen by monte carlo search tree."""
+
+        # Stop the background search started after the last move
+        self.stopPondering()
         
         # If this is the first time getMove is called,
         # initialize 'root' and 'current' to node w/ opening gamestate
         if not hasattr(self, 'root'):
-            self.root = MCTree.MCNode(Gamestate.Gamestate())
+            self.root = self.newRoot(Gamestate.Gamestate())
             self.current = self.root
 
-        # Determine which moves have been made by each player in order to
-        # move 'current' down the tree to the node corresponding to update
-        if not self.current.gamestate.equals(update):
-            colorToCheck = self.color + 1
-            if colorToCheck == 5:
-                colorToCheck = 1
-            while True:
-
-                # Find move made by player, then move down tree to corresponding
-                # node, or create it if necessary
-                moveMade = self.findMoveMade(self.current.gamestate, update, colorToCheck)
-
-                if moveMade in self.current.children:
-                    self.current = self.current.children[moveMade]
-                else:
-                    new_gamestate = self.current.gamestate.duplicate()
-                    new_gamestate.update(moveMade)
-                    self.current.children[moveMade] = MCTree.MCNode(new_gamestate, parent = self.current)
-                    self.current = self.current.children[moveMade]
-
-                # Go to next player in order
-                colorToCheck = colorToCheck + 1
-                if colorToCheck == 5:
-                    colorToCheck = 1
-                if colorToCheck == self.color:
-                    break
-                
-        # Then repeat Monte Carlo iterations until you run out of time
+        # Move 'current' down the tree to the node corresponding to update
+        self.followUpdate(update)
 
-        start_time = time.time()
-        while (time.time() - start_time < 30):
-            self.mcIteration()
+        # Then repeat Monte Carlo iterations until you run out of time
+        self.search()
 
         self.current.printTree()
         
         # And pick best move
 
-        move = self.highestAvgPlayoutMove(self.current)
+        move = self.bestMove(self.current)
 
         # Update tree to reflect path taken
-        if move in self.current.children:
-            self.current = self.current.children[move]
-        else:
-            new_gamestate = self.current.duplicate()
-            new_gamestate.update(move)
-            self.current.children[move] = MCNode(new_gamestate, parent = self.current)
-            self.current = self.current.children[move]
+        self.current = self.childFor(self.current, move)
 
         # Then return the move to make
         print("MAKING MOVE:")
-        print(move)
+        print(Placements.toTuple(move))
         print("self.current.gamestate.board:")
         print(self.current.gamestate.board)
+
+        # Keep searching while the others think
+        if self.ponder:
+            self.startPondering()
         return(move)
         
+    def followUpdate(self, update):
+        """Move 'current' down the tree to the node corresponding to update, adding nodes for moves not yet in it."""
+        # Determine which moves have been made by each player
+        # Players who can never move again are skipped, so follow the turn
+        # order of the tree's own gamestates
+        while (self.current.gamestate != update
+               and not self.current.gamestate.isTerminal()):
+            colorToCheck = self.current.gamestate.turn
+            if colorToCheck == self.color:
+                break
+
+            # Find move made by player, then move down tree to corresponding
+            # node, or create it if necessary
+            moveMade = self.findMoveMade(self.current.gamestate, update, colorToCheck)
+            self.current = self.childFor(self.current, moveMade)
+
+    def childFor(self, node, move):
+        """Return the child of node reached by move, creating it if necessary."""
+        children = node.children
+        if move in children:
+            return children[move]
+        new_gamestate = node.gamestate.duplicate()
+        new_gamestate.update(move)
+        return node.addChild(move, new_gamestate)
+
+    def startPondering(self):
+        """Start running Monte Carlo iterations from current in a background thread."""
+        self.ponderStop = threading.Event()
+        self.ponderThread = threading.Thread(target = self.ponderLoop)
+        self.ponderThread.daemon = True
+        self.ponderThread.start()
+
+    def ponderLoop(self):
+        """Repeat Monte Carlo iterations from current until told to stop or the budget's node or memory limit is reached."""
+        budget = SearchBudget.SearchBudget(nodes = self.budget.nodes,
+                                           memory = self.budget.memory,
+                                           checkEvery = self.budget.checkEvery)
+        try:
+            while (not self.ponderStop.is_set()
+                   and not self.current.gamestate.isTerminal()
+                   and budget.nextIteration()):
+                budget.addNodes(self.mcIteration())
+        except Exception:
+            # Report it here, since nothing waits on the thread's result;
+            # the next getMove searches as usual
+            print("Pondering stopped by an error:")
+            traceback.print_exc()
+
+    def stopPondering(self):
+        """Stop the background thread started by startPondering, if any, and wait for its iteration to finish."""
+        if hasattr(self, 'ponderThread'):
+            self.ponderStop.set()
+            self.ponderThread.join()
+            del self.ponderThread
+
+    def close(self):
+        """Stop pondering."""
+        self.stopPondering()
+
+    def newRoot(self, gamestate):
+        """Return a new root node for gamestate."""
+        return MCTree.MCNode(gamestate)
+
+    def search(self):
+        """Repeat Monte Carlo iterations from current until the budget runs out, and report what was used."""
+        self.budget.start()
+        while self.budget.nextIteration():
+            self.budget.addNodes(self.mcIteration())
+        self.reportSearch(self.budget.report())
+
+    def reportSearch(self, report):
+        """Keep and print the report of a finished search."""
+        self.lastSearch = report
+        print(SearchBudget.describe(report))
+
     def findMoveMade(self, prev, update, color):
         """Return what move (if any) was made by provided player between prev and update.""" 
 
@@ -88,15 +173,17 @@ class monteCarloPlayer(Players.AIPlayer):
                 break
 
         if piecePlayed == None:
-            return "pass!"
+            return Placements.PASS
 
         # Find coordinates that have changed
-        size = Gamestate.Gamestate.referenceHand[piece].size
+        size = Pieces.pieceSizes[piecePlayed]
         coordinates = np.zeros((2, size), dtype = np.int)
         squaresFound = 0
+        prevBoard = prev.board
+        updateBoard = update.board
         for i in range(0, Gamestate.Gamestate.boardsize):
             for j in range(0, Gamestate.Gamestate.boardsize):
-                if prev.board[i,j] == 0 and update.board[i,j] == color:
+                if prevBoard[i,j] == 0 and updateBoard[i,j] == color:
                     coordinates[0, squaresFound] = j
                     coordinates[1, squaresFound] = i
                     squaresFound = squaresFound + 1
@@ -105,36 +192,58 @@ class monteCarloPlayer(Players.AIPlayer):
             if squaresFound == size:
                 break
 
-        orientation = Gamestate.Gamestate.referenceHand[piece].matchingOrientation(coordinates)
+        orientation = Pieces.matchingOrientation(piecePlayed, coordinates)
         moveExtremes = bfn.findExtremes(coordinates)
         minx, miny = moveExtremes[0], moveExtremes[2]
 
-        return (piece, orientation, minx, miny)
+        return Placements.fromTuple((piecePlayed, orientation, minx, miny))
 
     def mcIteration(self):
-        """Iterate Monte Carlo search tree algorithm by doing a single step-through/expansion/playout/update."""
+        """Iterate Monte Carlo search tree algorithm by doing a single step-through/expansion/playout/update, and return the number of nodes added."""
 
         # Step through the tree according to upper confidence bounds until we
         # reach a node whose children have not all been explored
-        node = self.current
-        canStep = self.ucbStep(node)
-        while not canStep == False:
-            node = node.children[canStep]
-            canStep = self.ucbStep(node)
+        node = self.selectNode()
+        added = 0 if node.gamestate.isTerminal() else 1
 
         # Then expand that node, saving the result (utility vector) of
         # random playout
         result = node.expand()
 
         # Backpropagate that result through node's parents
-        node = node.parent
-        while not node is None and not node is self.current:
-            node.updateStats(result)
+        self.backpropagate(node, result)
+        return added
+
+    def selectNode(self):
+        """Step down from current by highest UCB through fully expanded nodes and return the first node that is not."""
+        node = self.current
+        canStep = self.ucbStep(node)
+        while canStep is not None:
+            node = node.children[canStep]
+            canStep = self.ucbStep(node)
+        return node
+
+    def backpropagate(self, node, result):
+        """Update stats of the parents of node, whose own stats are already updated, up to and including current, with a playout's utility vector.
+
+        current is counted so that its playouts are the real visit count
+        UCB takes for its children."""
+        while node != self.current and node.parent is not None:
             node = node.parent
+            node.updateStats(result)
+
+    def bestMove(self, node):
+        """Return the move to make from node: the child with highest average playout, or if it has no children, its first legal move (or a pass)."""
+        move = self.highestAvgPlayoutMove(node)
+        if move is None:
+            move = node.gamestate.canMove()
+            if move is False:
+                move = Placements.PASS
+        return move
 
     def highestAvgPlayoutMove(self, node):
         """Return the move corresponding to the child of the given node with highest average playout."""
-        color = node.gamestate.turn
+        color = node.turn
         highestAvg = -1
         highestAvgMove = None
         for move, child in node.children.items():
@@ -149,33 +258,235 @@ class monteCarloPlayer(Players.AIPlayer):
             
     def highestUCBMove(self, node):
         """Return the move corresponding to the child of the given node with the highest UCB."""
-        color = node.gamestate.turn
-        highestUCB = -1
-        highestUCBMove = None
-        for move, child in node.children.items():
-            if child.playouts != 0:
-                # The upper confidence bound of a node is
-                # xi + sqrt(2*ln(n)/ni)
-                # where n is total playouts from current gamestate,
-                # ni = total playouts from node i,
-                # wi = total wins from node i for player color, 
-                # and xi = average payout for node i (wi/ni)
-                currNodeUCB = (child.wins[color-1]/(child.playouts*1.0)
-                               + np.sqrt(2 * np.log(self.current.playouts)
-                                         / (child.playouts * 1.0)))
-            else:
-                currNodeUCB = 0
-            if currNodeUCB > highestUCB:
-                highestUCB = currNodeUCB
-                highestUCBMove = move
-        return highestUCBMove
+        moves, wins, playouts = node.childArrays()
+        return self.ucbMove(node.turn, moves, wins, playouts, node.playouts)
+
+    def ucbMove(self, color, moves, wins, playouts, parentPlayouts):
+        """Return the move of moves with the highest UCB for color, given arrays of the children's wins (n x 4) and playouts and their parent's playouts, or None if there are no moves."""
+        if len(moves) == 0:
+            return None
+        # The upper confidence bound of a node is
+        # xi + c*sqrt(ln(n)/ni)
+        # where n is total playouts from the parent node,
+        # ni = total playouts from node i,
+        # wi = total wins from node i for player color, 
+        # xi = average payout for node i (wi/ni)
+        # and c = exploration. Nodes without playouts get 0
+        ucb = np.zeros(len(moves))
+        visited = playouts > 0
+        ni = playouts[visited] * 1.0
+        ucb[visited] = (wins[visited, color-1] / ni
+                        + self.exploration * np.sqrt(logPlayouts(parentPlayouts) / ni))
+        return moves[int(np.argmax(ucb))]
             
     def ucbStep(self, node):
-        """If node is fully expanded, return move corresponding to child with highest UCB, else return false."""
+        """If node is fully expanded, return move corresponding to child with highest UCB, else return None."""
         if node.fullyExpanded:
             return self.highestUCBMove(node)
         else:
-            return False
+            return None
+
+class compactMCPlayer(monteCarloPlayer):
+    """Monte Carlo player keeping its tree in a MCTree.NodeStore, a few dozen bytes per node, rebuilding gamestates as they are needed."""
+
+    def newRoot(self, gamestate):
+        """Return a handle on the root of a new node store for gamestate."""
+        return MCTree.StoredMCNode(MCTree.NodeStore(gamestate))
+
+def rootSearch(job):
+    """Grow a tree from a gamestate in a worker process and return (stats, report): the stats of its root's children as a dict of move to (wins, playouts), and its search report.
+
+    job is (gamestate, color, budget, seed)."""
+    gamestate, color, budget, seed = job
+    random.seed(seed)
+    np.random.seed(seed)
+    player = monteCarloPlayer(color, budget)
+    player.root = MCTree.MCNode(gamestate)
+    player.current = player.root
+    player.search()
+    return (dict((move, (child.wins, child.playouts))
+                 for move, child in player.root.children.items()),
+            player.lastSearch)
+
+def leafRollouts(job):
+    """Play a position packed by Rollouts.pack out count times in a worker process and return the utility vectors.
+
+    job is (packed, count, seed)."""
+    packed, count, seed = job
+    random.seed(seed)
+    return [Rollouts.packedRollout(packed)[1] for i in range(count)]
+
+class poolMCPlayer(monteCarloPlayer):
+    """Abstract Monte Carlo player with a pool of worker processes."""
+
+    # Worker processes; the pool is started when first needed and kept
+    # for every move after it
+    workers = multiprocessing.cpu_count()
+
+    # Seed of the generator of the workers' seeds, or None for an
+    # unpredictable one
+    seed = None
+
+    def startPool(self):
+        """Start the worker pool and seed generator if they are not running yet."""
+        if not hasattr(self, 'pool'):
+            self.pool = multiprocessing.Pool(self.workers)
+            self.rng = random.Random(self.seed)
+
+    def close(self):
+        """Stop pondering and shut down the worker pool."""
+        monteCarloPlayer.close(self)
+        if hasattr(self, 'pool'):
+            self.pool.close()
+            self.pool.join()
+            del self.pool
+
+class rootParallelMCPlayer(poolMCPlayer):
+    """Monte Carlo player that grows an independent tree from current in each of a pool of worker processes, and merges their root statistics."""
+
+    def search(self):
+        """Search from current in every worker, sharing the budget's iterations and nodes between them, then add their stats for each move to current's children."""
+        self.startPool()
+        budget = self.budget.share(self.workers)
+        jobs = [(self.current.gamestate, self.color, budget,
+                 self.rng.getrandbits(32))
+                for i in range(self.workers)]
+        reports = list()
+        for stats, report in self.pool.map(rootSearch, jobs):
+            for move, (wins, playouts) in stats.items():
+                child = self.childFor(self.current, move)
+                child.playouts = child.playouts + playouts
+                child.wins = [child.wins[i] + wins[i] for i in range(0,4)]
+            reports.append(report)
+
+        # Iterations and nodes add up over the workers; time and memory
+        # are the most any one used
+        self.reportSearch({'milliseconds': max(report['milliseconds'] for report in reports),
+                           'iterations': sum(report['iterations'] for report in reports),
+                           'nodes': sum(report['nodes'] for report in reports),
+                           'memory': max(report['memory'] for report in reports),
+                           'stopped': reports[0]['stopped']})
+
+class leafParallelMCPlayer(poolMCPlayer):
+    """Monte Carlo player that plays each expanded node out several times at once in a pool of worker processes."""
+
+    # Playouts of each expanded node, shared out between the workers
+    leafPlayouts = multiprocessing.cpu_count()
+
+    def mcIteration(self):
+        """Step through the tree and expand a node as monteCarloPlayer does, then play the new node out leafPlayouts times in the pool and backpropagate every result."""
+        node = self.selectNode()
+        if node.gamestate.isTerminal():
+            result = node.expand()
+            self.backpropagate(node, result)
+            return 0
+
+        leaf = node.expandChild()
+        for result in self.leafResults(leaf.gamestate):
+            leaf.updateStats(result)
+            self.backpropagate(leaf, result)
+        return 1
+
+    def leafResults(self, gamestate):
+        """Return the utility vectors of leafPlayouts weighted playouts of gamestate, run in the pool."""
+        self.startPool()
+
+        # Positions are sent packed, a few hundred bytes rather than a
+        # pickled gamestate
+        packed = Rollouts.pack(gamestate)
+        jobs = list()
+        for i in range(min(self.workers, self.leafPlayouts)):
+            count = self.leafPlayouts // self.workers
+            if i < self.leafPlayouts % self.workers:
+                count = count + 1
+            jobs.append((packed, count, self.rng.getrandbits(32)))
+        results = list()
+        for utilities in self.pool.map(leafRollouts, jobs):
+            results.extend(utilities)
+        return results
+
+class treeParallelMCPlayer(poolMCPlayer):
+    """Monte Carlo player with one thread per worker walking a single shared tree, each sending its playouts to the pool.
+
+    Stats live in a MCTree.NodeStats shared by the tree's nodes. While a
+    thread's playout is under way, every node on its path carries a
+    virtual loss, so other threads select elsewhere."""
+
+    # Virtual losses put on each node of a thread's path
+    virtualLoss = 1
+
+    def newRoot(self, gamestate):
+        """Return a new root node for gamestate, with a new stats store."""
+        self.store = MCTree.NodeStats()
+        return MCTree.SharedMCNode(gamestate, store = self.store)
+
+    def search(self):
+        """Search from current with workers threads until the budget, which they share, runs out."""
+        self.startPool()
+        self.budget.start()
+        threads = [threading.Thread(target = self.searchThread)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.reportSearch(self.budget.report())
+
+    def searchThread(self):
+        """Repeat tree iterations until the budget runs out."""
+        while self.budget.nextIteration():
+            self.budget.addNodes(self.treeIteration())
+
+    def treeIteration(self):
+        """Do a single step-through/expansion/playout/update, with virtual losses on the path while the playout runs in the pool, and return the number of nodes added."""
+
+        # Step through the tree by UCB until we reach a node that is not
+        # fully expanded, then expand it, holding its lock
+        node = self.current
+        path = list()
+        while True:
+            move = self.ucbStep(node)
+            if move is None:
+                with self.store.expandLock(node.id):
+                    if node.gamestate.isTerminal():
+                        leaf = node
+                        break
+                    if not node.fullyExpanded:
+                        leaf = node.expandChild()
+                        path.append(leaf)
+                        self.store.addVirtual(leaf.id, self.virtualLoss)
+                        break
+                # Another thread expanded its last child meanwhile
+                continue
+            node = node.children[move]
+            path.append(node)
+            self.store.addVirtual(node.id, self.virtualLoss)
+
+        # Play out, and update stats as mcIteration does
+        added = 0
+        if leaf is node:
+            result = Players.utility(leaf.gamestate)
+        else:
+            added = 1
+            job = (Rollouts.pack(leaf.gamestate), 1, self.rng.getrandbits(32))
+            result = self.pool.apply(leafRollouts, (job,))[0]
+        leaf.updateStats(result)
+        self.backpropagate(leaf, result)
+
+        for step in path:
+            self.store.addVirtual(step.id, -self.virtualLoss)
+        return added
+
+    def highestUCBMove(self, node):
+        """Return the move corresponding to the child of the given node with the highest UCB, counting virtual losses."""
+        # As in monteCarloPlayer, with each virtual loss counted as a
+        # playout without a win
+        children = node.children
+        moves = list(children.keys())
+        wins, playouts, virtual = self.store.gather([children[move].id for move in moves])
+        parentWins, parentPlayouts, parentVirtual = self.store.stats(node.id)
+        return self.ucbMove(node.turn, moves, wins, playouts + virtual,
+                            int(parentPlayouts + parentVirtual))
 
 class persistentMCPlayer(monteCarloPlayer):
 
@@ -184,68 +495,42 @@ class persistentMCPlayer(monteCarloPlayer):
     def getMove(self, update):
         """Prompted with gamestate, return move chosen by MCTS with tree loaded from file."""
 
+        # Stop the background search started after the last move
+        self.stopPondering()
+
         # If this is the first time getMove is called, either read root from file
         # or initialize new one. Then set 'current' to last known gamestate
         if not hasattr(self, 'root'):
             if persistentMCPlayer.shouldReadTree:
                 self.root = self.readTree()
             else:
-                self.root = MCTree.MCNode(Gamestate.Gamestate())
+                self.root = self.newRoot(Gamestate.Gamestate())
             self.current = self.root
 
-        # Determine which moves have been made by each player in order to
-        # move 'current' down the tree to the node corresponding to update
-        if not self.current.gamestate.equals(update):
-            colorToCheck = self.color + 1
-            if colorToCheck == 5:
-                colorToCheck = 1
-            while True:
-
-                # Find move made by player, then move down tree to corresponding
-                # node, or create it if necessary
-                moveMade = self.findMoveMade(self.current.gamestate, update, colorToCheck)
-
-                if moveMade in self.current.children:
-                    self.current = self.current.children[moveMade]
-                else:
-                    new_gamestate = self.current.gamestate.duplicate()
-                    new_gamestate.update(moveMade)
-                    self.current.children[moveMade] = MCTree.MCNode(new_gamestate, parent = self.current)
-                    self.current = self.current.children[moveMade]
-
-                # Go to next player in order
-                colorToCheck = colorToCheck + 1
-                if colorToCheck == 5:
-                    colorToCheck = 1
-                if colorToCheck == self.color:
-                    break
-                
-        # Then repeat Monte Carlo iterations until you run out of time
+        # Move 'current' down the tree to the node corresponding to update
+        self.followUpdate(update)
 
-        start_time = time.time()
-        while (time.time() - start_time < 30):
-            self.mcIteration()
+        # Then repeat Monte Carlo iterations until you run out of time
+        self.search()
 
         self.current.printTree()
         
         # And pick best move
 
-        move = self.highestAvgPlayoutMove(self.current)
+        move = self.bestMove(self.current)
 
         # Update tree to reflect path taken
-        if move in self.current.children:
-            self.current = self.current.children[move]
-        else:
-            new_gamestate = self.current.duplicate()
-            new_gamestate.update(move)
-            self.current.children[move] = MCNode(new_gamestate, parent = self.current)
-            self.current = self.current.children[move]
+        self.current = self.childFor(self.current, move)
 
         # Then return the move to make
         print("MAKING MOVE:")
-        print(move)
+        print(Placements.toTuple(move))
         print("self.current.gamestate.board:")
         print(self.current.gamestate.board)
+
+        # Keep searching while the others think
+        if self.ponder:
+            self.startPondering()
         return(move)
 
     def writeTree(self):
@@ -3,20 +3,112 @@
 
 import Gamestate
 import Players
+import Placements
+import Rollouts
 import BlokusFunctions as bfn
 import sys
+import array
 import random
-import pdb
+import threading
+import collections
+import numpy as np
 
-class MCNode():
+# Typecode of the arrays untried moves are kept in: two bytes a move while
+# every placement ID fits
+if len(Placements.table) <= 0xffff:
+    moveTypecode = 'H'
+else:
+    moveTypecode = 'i'
 
-    def __init__(self, gamestate, parent = None, fullyExpanded = False, playouts = 0):
+def weightedOrder(moves):
+    """Return moves shuffled so that popping from the end picks them as repeated Players.weightedRandomMove calls on those left would."""
+    # Sorting by random() ** (1 / weight) draws an order without
+    # replacement with each pick proportional to its weight
+    keyed = list()
+    for move in moves:
+        if move != Placements.PASS:
+            weight = Placements.table[move].size
+        else:
+            weight = 1
+        keyed.append((random.random() ** (1.0 / weight), move))
+    keyed.sort()
+    return [move for key, move in keyed]
+
+class ChildStats(object):
+    """Wins and playouts of the children of one node, in arrays indexed in the order the children were added."""
+
+    def __init__(self, size = 4):
+        # moves: move leading to each child
+        # playouts, wins: as in MCNode, in the first len(moves) entries;
+        #     wins n x 4. Both double in size when they fill up
+        self.moves = list()
+        self.playouts = np.zeros(size, dtype=np.int64)
+        self.wins = np.zeros((size, 4), dtype=np.int64)
+
+    def add(self, move):
+        """Add an entry with no stats for the child reached by move and return its index."""
+        index = len(self.moves)
+        if index == len(self.playouts):
+            self.playouts = np.concatenate((self.playouts, np.zeros_like(self.playouts)))
+            self.wins = np.concatenate((self.wins, np.zeros_like(self.wins)))
+        self.moves.append(move)
+        return index
+
+    def arrays(self):
+        """Return (moves, wins, playouts) of the children added so far, wins n x 4."""
+        count = len(self.moves)
+        return self.moves, self.wins[:count], self.playouts[:count]
+
+class MCNode(object):
+
+    def __init__(self, gamestate, parent = None, fullyExpanded = False, playouts = 0,
+                 move = Placements.PASS):
         self.gamestate = gamestate
         self.parent = parent
         self.children = dict()
         self.fullyExpanded = False
+
+        # childStats: ChildStats of this node's children, so UCB can be
+        # worked out for all of them at once
+        # stats, index: this node's own wins and playouts are entry index
+        #     of stats, its parent's childStats (or one of its own at the
+        #     root)
+        self.childStats = ChildStats()
+        if parent is None:
+            self.stats = ChildStats(1)
+        else:
+            self.stats = parent.childStats
+        self.index = self.stats.add(move)
         self.playouts = playouts
-        self.wins = [0,0,0,0]
+
+        # Moves without a child yet, in the order they will be tried, as
+        # an array of moveTypecode; None until the first expansion
+        self.untried = None
+
+    def getPlayouts(self):
+        return int(self.stats.playouts[self.index])
+
+    def setPlayouts(self, playouts):
+        self.stats.playouts[self.index] = playouts
+
+    def getWins(self):
+        return [int(wins) for wins in self.stats.wins[self.index]]
+
+    def setWins(self, wins):
+        self.stats.wins[self.index] = wins
+
+    def getTurn(self):
+        return self.gamestate.turn
+
+    playouts = property(getPlayouts, setPlayouts)
+    wins = property(getWins, setWins)
+
+    # Color to move at this node
+    turn = property(getTurn)
+
+    def childArrays(self):
+        """Return (moves, wins, playouts) of this node's children as a list and arrays, wins n x 4."""
+        return self.childStats.arrays()
         
     def printTree(self):
         """Print the tree written on this node."""
@@ -32,19 +124,24 @@ class MCNode():
         for move, child in self.children.items():
             for i in range(0, indent):
                 sys.stdout.write("\t")
-            print(move)
+            print(Placements.toTuple(move))
             sys.stdout.write("Wins: ")
             sys.stdout.write(str(child.wins))
             sys.stdout.write("/Playouts:")
             print(str(child.playouts))
             child.printTreeRec(indent + 1)
 
+    def addChild(self, move, gamestate):
+        """Add and return a new node of the same kind as this one for move, which leads to gamestate."""
+        self.children[move] = self.__class__(gamestate, parent = self, move = move)
+        return self.children[move]
+
     def updateStats(self, utility_vector):
         """Update node's wins and playouts based on a descendant's utility vector."""
-        self.playouts = self.playouts + 1
+        self.stats.playouts[self.index] += 1
         for i in range(0,4):
             if utility_vector[i] == 1:
-                self.wins[i] = self.wins[i] + 1
+                self.stats.wins[self.index, i] += 1
 
     def expand(self):
         """Expand a random unvisited child from node, play out simulation, update stats, and return utility vector result."""
@@ -52,91 +149,378 @@ class MCNode():
             utilityVector = Players.utility(self.gamestate)
             self.updateStats(utilityVector)
             return utilityVector
-        
-        unexplored_moves = self.gamestate.listMoves()
-        for move, child in self.children.items():
-            try:
-                unexplored_moves.remove(move)
-            except ValueError:
-                pdb.set_trace()
-        print("Moves remaining:")
-        print(unexplored_moves)
-        print("Testing:")
-        randMove = Players.weightedRandomMove(unexplored_moves)
-        print(randMove)
-        
-        # Expand
-        new_gamestate = self.gamestate.duplicate()
-        new_gamestate.update(randMove)
-        self.children[randMove] = MCNode(new_gamestate, parent = self)
-        new_node = self.children[randMove]
+
+        new_node = self.expandChild()
         
         # Run simulation from new node
         sim_result = new_node.simulateWeightedGame()
         
         # Update own stats with this result
         self.updateStats(sim_result)
-        
-        # Update fullyExpanded if necessary
-        if len(unexplored_moves) == 1:
-            self.fullyExpanded = True
 
         # Return result of simulation (utility vector) for backpropagation
         return sim_result
 
-    def simulateGame(self):
-        """Simulate a random game starting from this node, and return utility vector outcome."""
+    def expandChild(self):
+        """Add a child for a random unvisited move from this non-terminal node and return it, without playing it out."""
+        unexplored_moves = self.untriedMoves()
+        print("Testing:")
+        randMove = unexplored_moves.pop()
+        print(Placements.toTuple(randMove))
+        
+        # Expand
+        new_gamestate = self.gamestate.duplicate()
+        new_gamestate.update(randMove)
+        new_node = self.addChild(randMove, new_gamestate)
+        
+        # Update fullyExpanded if necessary
+        if len(unexplored_moves) == 0:
+            self.fullyExpanded = True
 
-        print("Simulating random game..")
+        return new_node
 
-        # Simulate game 
-        gamestate = self.gamestate.duplicate()
-        while not gamestate.isTerminal():
-            moves = gamestate.listMoves()
-            randMove = random.choice(moves)
-            gamestate.update(randMove)
-            
-        # Update playout and win count in self
-        utility_vector = Players.utility(gamestate)
-        self.updateStats(utility_vector)
+    def untriedMoves(self):
+        """Return the array of moves without a child yet, last to be tried next, listing them on first use."""
+        if self.untried is None:
+            self.untried = self.listUntried()
+        return self.untried
 
-        # Return utility vector for backpropagation
-        return utility_vector
+    def listUntried(self):
+        """Return the legal moves without a child yet in weightedOrder, as an array of moveTypecode."""
+        children = self.children
+        return array.array(moveTypecode,
+                           weightedOrder([move for move in self.gamestate.listMoves()
+                                          if move not in children]))
+
+    def simulateGame(self):
+        """Simulate a random game starting from this node, and return utility vector outcome."""
+        return self.simulate(Rollouts.UNIFORM)
 
     def simulateWeightedGame(self):
         """Simulate a game with random moves weighted by piece size, and return utility vector outcome."""
-        print("Simulating weighted random game..")
-
-        # Simulate game 
-        gamestate = self.gamestate.duplicate()
-        while not gamestate.isTerminal():
-            moves = gamestate.listMoves()
-            randMove = Players.weightedRandomMove(moves)
-            gamestate.update(randMove)
-            
-        # Update playout and win count in self
-        utility_vector = Players.utility(gamestate)
-        self.updateStats(utility_vector)
-
-        # Return utility vector for backpropagation
-        return utility_vector
+        return self.simulate(Rollouts.WEIGHTED)
 
     def simulateGameWithFirstMoves(self):
         """Simulate a game where players pick first moves, and return utility vector outcome."""
-        print("Simulating game with first moves...")
+        return self.simulate(Rollouts.FIRSTFIT)
 
-        # Simulate game
-        gamestate = self.gamestate.duplicate()
-        while not gamestate.isTerminal():
-            move = gamestate.canMove()
-            if not move == False:
-                gamestate.update(move)
-            else:
-                gamestate.update('pass!')
+    def simulate(self, policy):
+        """Play this node's gamestate out with a Rollouts policy, update stats, and return utility vector outcome."""
+        scores, utility_vector = Rollouts.rollout(self.gamestate, policy)
 
         # Update playout and win count in self
-        utility_vector = Players.utility(gamestate)
         self.updateStats(utility_vector)
 
         # Return utility vector for backpropagation
         return utility_vector
+
+class NodeStats(object):
+    """Wins, playouts and virtual losses of the nodes of one tree, in arrays indexed by node ID, shared by the threads searching it."""
+
+    # Nodes per block of arrays; blocks are added as nodes are, so arrays
+    # already handed out never move
+    blockSize = 4096
+
+    def __init__(self, stripes = 64):
+        # wins: blocks of blockSize x 4 wins per color
+        # playouts, virtual: blocks of playouts and of virtual losses
+        #     (playouts under way, counted as losses while selecting)
+        # count: nodes added so far
+        # locks: stats of node ID are changed under locks[ID % stripes],
+        #     and its children are added under expandLocks[ID % stripes]
+        self.wins = list()
+        self.playouts = list()
+        self.virtual = list()
+        self.count = 0
+        self.growLock = threading.Lock()
+        self.locks = [threading.Lock() for i in range(stripes)]
+        self.expandLocks = [threading.Lock() for i in range(stripes)]
+
+    def newNode(self):
+        """Return the ID of a new node with no stats."""
+        with self.growLock:
+            id = self.count
+            if id % NodeStats.blockSize == 0:
+                self.wins.append(np.zeros((NodeStats.blockSize, 4), dtype=np.int64))
+                self.playouts.append(np.zeros(NodeStats.blockSize, dtype=np.int64))
+                self.virtual.append(np.zeros(NodeStats.blockSize, dtype=np.int64))
+            self.count = id + 1
+        return id
+
+    def stats(self, id):
+        """Return (wins, playouts, virtual losses) of node ID."""
+        block, i = divmod(id, NodeStats.blockSize)
+        return self.wins[block][i], self.playouts[block][i], self.virtual[block][i]
+
+    def update(self, id, utility_vector):
+        """Count a playout with result utility_vector for node ID."""
+        block, i = divmod(id, NodeStats.blockSize)
+        with self.locks[id % len(self.locks)]:
+            self.playouts[block][i] += 1
+            for color in range(0, 4):
+                if utility_vector[color] == 1:
+                    self.wins[block][i, color] += 1
+
+    def gather(self, ids):
+        """Return (wins, playouts, virtual losses) of the nodes in ids as arrays, wins n x 4."""
+        ids = np.asarray(ids, dtype=np.int64)
+        blocks, rows = np.divmod(ids, NodeStats.blockSize)
+        wins = np.zeros((len(ids), 4), dtype=np.int64)
+        playouts = np.zeros(len(ids), dtype=np.int64)
+        virtual = np.zeros(len(ids), dtype=np.int64)
+        for block in np.unique(blocks):
+            mask = blocks == block
+            wins[mask] = self.wins[block][rows[mask]]
+            playouts[mask] = self.playouts[block][rows[mask]]
+            virtual[mask] = self.virtual[block][rows[mask]]
+        return wins, playouts, virtual
+
+    def set(self, id, wins = None, playouts = None):
+        """Overwrite the wins and/or playouts of node ID."""
+        block, i = divmod(id, NodeStats.blockSize)
+        with self.locks[id % len(self.locks)]:
+            if wins is not None:
+                self.wins[block][i] = wins
+            if playouts is not None:
+                self.playouts[block][i] = playouts
+
+    def addVirtual(self, id, amount):
+        """Add amount (which may be negative) to the virtual losses of node ID."""
+        block, i = divmod(id, NodeStats.blockSize)
+        with self.locks[id % len(self.locks)]:
+            self.virtual[block][i] += amount
+
+    def expandLock(self, id):
+        """Return the lock to hold while adding children to node ID."""
+        return self.expandLocks[id % len(self.expandLocks)]
+
+class SharedMCNode(MCNode):
+    """Node whose wins and playouts are kept in a NodeStats shared by the whole tree."""
+
+    def __init__(self, gamestate, parent = None, store = None, move = Placements.PASS):
+        if store is None:
+            store = parent.store
+        self.store = store
+        self.id = store.newNode()
+        MCNode.__init__(self, gamestate, parent = parent, move = move)
+
+    def getPlayouts(self):
+        return int(self.store.stats(self.id)[1])
+
+    def setPlayouts(self, playouts):
+        self.store.set(self.id, playouts = playouts)
+
+    def getWins(self):
+        return [int(wins) for wins in self.store.stats(self.id)[0]]
+
+    def setWins(self, wins):
+        self.store.set(self.id, wins = wins)
+
+    playouts = property(getPlayouts, setPlayouts)
+    wins = property(getWins, setWins)
+
+    def childArrays(self):
+        """Return (moves, wins, playouts) of this node's children as a list and arrays, wins n x 4."""
+        moves = list(self.children.keys())
+        wins, playouts, virtual = self.store.gather([self.children[move].id for move in moves])
+        return moves, wins, playouts
+
+    def updateStats(self, utility_vector):
+        """Update node's wins and playouts based on a descendant's utility vector."""
+        self.store.update(self.id, utility_vector)
+
+class NodeStore(object):
+    """A whole search tree as parallel NumPy arrays indexed by node ID, grown in chunks, with node 0 as root.
+
+    Nodes do not keep gamestates: a node's gamestate is rebuilt by replaying
+    the moves down to it from its nearest ancestor in a small LRU cache of
+    gamestates. The root's gamestate is always kept."""
+
+    # Nodes added to the arrays each time they fill up
+    chunkSize = 4096
+
+    # Gamestates kept besides the root's
+    cacheSize = 64
+
+    def __init__(self, gamestate):
+        # parent, firstChild, nextSibling: node IDs, or -1 for none;
+        #     children of a node form a list through nextSibling
+        # move: placement ID of the move leading to the node
+        # turn: color to move at the node, so selection need not rebuild
+        #     its gamestate
+        # expanded: whether every child of the node has been added
+        # playouts, wins: as in MCNode, wins n x 4
+        # count: nodes added so far
+        # rootState: gamestate of node 0
+        # cache: node ID to gamestate, least recently used first
+        # untried: node ID to its MCNode.untried array, for nodes being
+        #     expanded
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.firstChild = np.zeros(0, dtype=np.int32)
+        self.nextSibling = np.zeros(0, dtype=np.int32)
+        self.move = np.zeros(0, dtype=np.int32)
+        self.turn = np.zeros(0, dtype=np.int8)
+        self.expanded = np.zeros(0, dtype=bool)
+        self.playouts = np.zeros(0, dtype=np.int32)
+        self.wins = np.zeros((0, 4), dtype=np.int32)
+        self.count = 0
+        self.rootState = gamestate
+        self.cache = collections.OrderedDict()
+        self.untried = dict()
+        self.add(-1, Placements.PASS, gamestate.turn)
+
+    def grow(self):
+        """Make room for chunkSize more nodes."""
+        size = len(self.parent) + NodeStore.chunkSize
+        for name in ('parent', 'firstChild', 'nextSibling', 'move', 'turn', 'expanded', 'playouts'):
+            setattr(self, name, np.resize(getattr(self, name), size))
+        self.wins = np.resize(self.wins, (size, 4))
+
+    def add(self, parent, move, turn):
+        """Add a node for move below node parent (-1 for the root), with color turn to move, and return its ID."""
+        if self.count == len(self.parent):
+            self.grow()
+        id = self.count
+        self.count = id + 1
+        self.parent[id] = parent
+        self.firstChild[id] = -1
+        self.move[id] = move
+        self.turn[id] = turn
+        self.expanded[id] = False
+        self.playouts[id] = 0
+        self.wins[id] = 0
+        if parent >= 0:
+            self.nextSibling[id] = self.firstChild[parent]
+            self.firstChild[parent] = id
+        else:
+            self.nextSibling[id] = -1
+        return id
+
+    def children(self, id):
+        """Return a list of (move, child ID) for the children of node ID."""
+        rtn = list()
+        child = self.firstChild[id]
+        while child >= 0:
+            rtn.append((int(self.move[child]), int(child)))
+            child = self.nextSibling[child]
+        return rtn
+
+    def update(self, id, utility_vector):
+        """Count a playout with result utility_vector for node ID."""
+        self.playouts[id] += 1
+        for i in range(0, 4):
+            if utility_vector[i] == 1:
+                self.wins[id, i] += 1
+
+    def remember(self, id, gamestate):
+        """Put gamestate in the cache as node ID's, dropping the least recently used if it is full."""
+        if id == 0:
+            return
+        self.cache.pop(id, None)
+        self.cache[id] = gamestate
+        if len(self.cache) > NodeStore.cacheSize:
+            self.cache.popitem(last = False)
+
+    def gamestate(self, id):
+        """Return node ID's gamestate, from the cache or replayed from its nearest cached ancestor."""
+        if id == 0:
+            return self.rootState
+        if id in self.cache:
+            gamestate = self.cache.pop(id)
+            self.cache[id] = gamestate
+            return gamestate
+
+        moves = list()
+        node = id
+        while node != 0 and node not in self.cache:
+            moves.append(int(self.move[node]))
+            node = self.parent[node]
+        gamestate = self.gamestate(node).duplicate()
+        for move in reversed(moves):
+            gamestate.update(move)
+        self.remember(id, gamestate)
+        return gamestate
+
+class StoredMCNode(MCNode):
+    """Handle on a node of a NodeStore, used like an MCNode; handles on the same node compare equal."""
+
+    def __init__(self, store, id = 0):
+        self.store = store
+        self.id = id
+
+    def __eq__(self, other):
+        return (isinstance(other, StoredMCNode) and other.store is self.store
+                and other.id == self.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.id
+
+    def getGamestate(self):
+        return self.store.gamestate(self.id)
+
+    def getParent(self):
+        parent = self.store.parent[self.id]
+        if parent < 0:
+            return None
+        return StoredMCNode(self.store, int(parent))
+
+    def getChildren(self):
+        return dict((move, StoredMCNode(self.store, child))
+                    for move, child in self.store.children(self.id))
+
+    def getFullyExpanded(self):
+        return bool(self.store.expanded[self.id])
+
+    def setFullyExpanded(self, fullyExpanded):
+        self.store.expanded[self.id] = fullyExpanded
+        if fullyExpanded:
+            self.store.untried.pop(self.id, None)
+
+    def getPlayouts(self):
+        return int(self.store.playouts[self.id])
+
+    def setPlayouts(self, playouts):
+        self.store.playouts[self.id] = playouts
+
+    def getWins(self):
+        return [int(wins) for wins in self.store.wins[self.id]]
+
+    def setWins(self, wins):
+        self.store.wins[self.id] = wins
+
+    def getTurn(self):
+        return int(self.store.turn[self.id])
+
+    gamestate = property(getGamestate)
+    parent = property(getParent)
+    children = property(getChildren)
+    fullyExpanded = property(getFullyExpanded, setFullyExpanded)
+    playouts = property(getPlayouts, setPlayouts)
+    wins = property(getWins, setWins)
+    turn = property(getTurn)
+
+    def childArrays(self):
+        """Return (moves, wins, playouts) of this node's children as a list and arrays, wins n x 4."""
+        children = self.store.children(self.id)
+        ids = np.array([child for move, child in children], dtype=np.int64)
+        return ([move for move, child in children],
+                self.store.wins[ids], self.store.playouts[ids])
+
+    def updateStats(self, utility_vector):
+        """Update node's wins and playouts based on a descendant's utility vector."""
+        self.store.update(self.id, utility_vector)
+
+    def untriedMoves(self):
+        """Return the array of moves without a child yet, last to be tried next, listing them on first use."""
+        if self.id not in self.store.untried:
+            self.store.untried[self.id] = self.listUntried()
+        return self.store.untried[self.id]
+
+    def addChild(self, move, gamestate):
+        """Add and return a node for move, which leads to gamestate, keeping gamestate in the cache."""
+        child = self.store.add(self.id, move, gamestate.turn)
+        self.store.remember(child, gamestate)
+        return StoredMCNode(self.store, child)
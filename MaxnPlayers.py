@@ -4,110 +4,171 @@
 import Pieces
 import Gamestate
 import Players
+import Placements
+import SearchBudget
 
-def maxn_getMove(gamestate, max_score):
+# Searches make and take back moves on a single working copy of the
+# gamestate with apply and undo, rather than duplicating it for every node
+
+# Each node visited is one iteration (and one node) of an optional
+# SearchBudget. Once it runs out, nodes are scored as they stand, as at the
+# depth limit, so the search still returns the best move found so far
+
+def maxn_getMove(gamestate, max_score, budget = None):
     """Wrapper for maxn search - return result of search."""
+    if budget is not None:
+        budget.start()
+    gamestate = gamestate.duplicate()
     color = gamestate.turn
     moves = gamestate.listMoves()
-    children = Players.expandFromList(gamestate, moves)
-    if len(children) != 0:
+    if len(moves) != 0:
         max_val = -100
         max_val_index = -1
-        for i in range(0, len(children)):
-            score = maxn(children[i], max_score)[color-1]
+        for i in range(0, len(moves)):
+            record = gamestate.apply(moves[i])
+            score = maxn(gamestate, max_score, budget)[color-1]
+            gamestate.undo(record)
             if score == max_score:
                 return moves[i]
             if score > max_val:
                 max_val = score
                 max_val_index = i
+            if outOfBudget(budget):
+                break
         return moves[max_val_index]
     else:
-        return list()
+        return Placements.PASS
+
+def withinBudget(budget):
+    """Return whether a search with budget (or None) may visit another node, counting it if so."""
+    if budget is None:
+        return True
+    if budget.nextIteration():
+        budget.addNodes(1)
+        return True
+    return False
+
+def outOfBudget(budget):
+    """Return whether a search with budget (or None) has been stopped by it."""
+    return budget is not None and budget.stopped is not None
 
 # NOTE: added immediate pruning
-def maxn(gamestate, max_score):
+def maxn(gamestate, max_score, budget = None):
     """Return result of maxn search for best outcome."""
     
-    # If gamestate is terminal, return vector of utility
-    if gamestate.isTerminal():
+    # If gamestate is terminal or the budget has run out, return vector
+    # of utility. Every node visited is counted, terminal or not
+    inBudget = withinBudget(budget)
+    if gamestate.isTerminal() or not inBudget:
         return Players.utility(gamestate)
     else:
-        # Expand to list of child gamestates; do maxn on each and find max
+        # Make each move in turn; do maxn on the result and find max
         color = gamestate.turn
-        children = Players.expand(gamestate)
-        if len(children) != 0:
+        moves = gamestate.listMoves()
+        if len(moves) != 0:
             max_val = [-100,-100, -100, -100]
-            for child in children:
-                score = maxn(child, max_score)
+            for move in moves:
+                record = gamestate.apply(move)
+                score = maxn(gamestate, max_score, budget)
+                gamestate.undo(record)
                 # If a child has the best possible score for a player,
                 # prune immediately and disregard other children
                 if score[color-1] == max_score:
                     return score
                 if score[color-1] > max_val[color-1]:
                     max_val = score
+                if outOfBudget(budget):
+                    break
 
             return max_val
         else:
             # If no moves are possible but gamestate is not terminal,
             # simply pass 
-            new_gamestate = gamestate.duplicate()
-            new_gamestate.update(list())
-            return maxn(new_gamestate, max_score)
+            record = gamestate.apply(Placements.PASS)
+            score = maxn(gamestate, max_score, budget)
+            gamestate.undo(record)
+            return score
     
 class impracticallyThoroughAIPlayer(Players.AIPlayer):
     """AI player which attempts a complete maxn search."""
     def getMove(self, update):
-        return maxn_getMove(update, 1)
+        move = maxn_getMove(update, 1, self.budget)
+        reportSearch(self.budget)
+        return move
 
-def xPlyMaxn_getMove(gamestate, maxdepth, max_score):
+def reportSearch(budget):
+    """Print what a search with budget (or None) used."""
+    if budget is not None:
+        print(SearchBudget.describe(budget.report()))
+
+def xPlyMaxn_getMove(gamestate, maxdepth, max_score, budget = None):
     """Wrapper for x-ply maxn search - return result of search."""
+    if budget is not None:
+        budget.start()
+    gamestate = gamestate.duplicate()
     color = gamestate.turn
     moves = gamestate.listMoves()
-    children = Players.expandFromList(gamestate, moves)
-    if len(children) != 0:
+    if len(moves) != 0:
         max_val = -100
         max_val_index = -1
-        for i in range(0, len(children)):
+        for i in range(0, len(moves)):
             print("testing my move")
-            score = xPlyMaxn(children[i], 1, maxdepth, max_score)[color-1]
+            record = gamestate.apply(moves[i])
+            score = xPlyMaxn(gamestate, 1, maxdepth, max_score, budget)[color-1]
+            gamestate.undo(record)
             if score == max_score:
                 return moves[i]
             if score > max_val:
                 max_val = score
                 max_val_index = i
+            if outOfBudget(budget):
+                break
         return moves[max_val_index]
     else:
-        return list()
+        return Placements.PASS
 
-def xPlyMaxn(gamestate, depth, maxdepth, max_score):
+def xPlyMaxn(gamestate, depth, maxdepth, max_score, budget = None):
     """Return result of x-ply maxn search for best outcome."""
     print("xPlyMaxn previewing:")
     print(gamestate.board)
-    if depth == maxdepth or gamestate.isTerminal():
+    # Every node visited is counted, leaves at the depth limit included
+    inBudget = withinBudget(budget)
+    if depth == maxdepth or gamestate.isTerminal() or not inBudget:
         print("terminal/reached depth limit")
         return Players.utility(gamestate)
     else:
         color = gamestate.turn
-        children = Players.expand(gamestate)
-        if len(children) != 0:
+        moves = gamestate.listMoves()
+        if len(moves) != 0:
             max_val = [-100, -100, -100, -100]
-            for child in children:
+            for move in moves:
                 print("testing their move")
-                score = xPlyMaxn(child, depth + 1, maxdepth, max_score)
+                record = gamestate.apply(move)
+                score = xPlyMaxn(gamestate, depth + 1, maxdepth, max_score, budget)
+                gamestate.undo(record)
                 if score[color-1] == max_score:
                     print("pruning")
                     return score
                 if score[color-1] > max_val[color-1]:
                     max_val = score
+                if outOfBudget(budget):
+                    break
             return max_val
         else:
-            child = gamestate.duplicate()
-            child.update(list())
-            return xPlyMaxn(child, depth + 1, maxdepth, max_score)
+            record = gamestate.apply(Placements.PASS)
+            score = xPlyMaxn(gamestate, depth + 1, maxdepth, max_score, budget)
+            gamestate.undo(record)
+            return score
     
     
 class xPlyAIPlayer(Players.AIPlayer):
     """AI player who uses x-ply maxn search to find moves."""
+
+    # Plies searched; the budget may stop the search sooner
+    maxDepth = 5
+
     def getMove(self, update):
-        return xPlyMaxn_getMove(update, 5, 1)
+        move = xPlyMaxn_getMove(update, self.maxDepth, 1, self.budget)
+        reportSearch(self.budget)
+        return move
         
@@ -11,6 +11,7 @@
 
 import numpy as np
 import pdb
+from collections import namedtuple
 import BlokusFunctions as bfn
 
 class Piece:
@@ -129,50 +130,7 @@ class Piece:
 
     def matchingOrientation(self, compare):
         """Return the orientation, if any, of this piece that matches the shape in compare, or -1 otherwise."""
-
-        compare = bfn.toBoolArray(compare)
-        boolshape = bfn.toBoolArray(self.shape)
-        if np.array_equal(boolshape, compare):
-            self.reduceOrientation()
-            return self.orientation
-
-        if self.r90 and self.r180:
-            for i in range(3):
-                self.rotate(1)
-                boolshape = bfn.toBoolArray(self.shape)
-                if np.array_equal(boolshape, compare):
-                    self.reduceOrientation()
-                    return self.orientation
-        elif self.r90 and not self.r180:
-            self.rotate(1)
-            boolshape = bfn.toBoolArray(self.shape)
-            if np.array_equal(boolshape, compare):
-                self.reduceOrientation()
-                return self.orientation
-
-        if self.chiral:
-            self.flipV()
-
-            boolshape = bfn.toBoolArray(self.shape)
-            if np.array_equal(boolshape, compare):
-                self.reduceOrientation()
-                return self.orientation
-
-            if self.r90 and self.r180:
-                for i in range(3):
-                    self.rotate(1)
-                    boolshape = bfn.toBoolArray(self.shape)
-                    if np.array_equal(boolshape, compare):
-                        self.reduceOrientation()
-                        return self.orientation
-            elif self.r90 and not self.r180:
-                self.rotate(1)
-                boolshape = bfn.toBoolArray(self.shape)
-                if np.array_equal(boolshape, compare):
-                    self.reduceOrientation()
-                    return self.orientation
-                
-        return -1
+        return matchingOrientation(self.name, compare)
 
     def reduceOrientation(self):
         """Change own orientation to the smallest congruent orientation considering piece's symmetry."""
@@ -504,4 +462,112 @@ class One(Piece):
         self.orientation = 0b000
 
 
-        
+# ORIENTATION TABLE
+# Every distinct fixed orientation of every piece, computed once at import time
+# so that move generation never has to rotate or flip a Piece.
+
+# name (str): name of the piece
+# orientation (int): orientation code, as in Piece.orientation
+# size (int): number of tiles
+# cells: tuple of (x, y) tile offsets, normalized so min x and min y are 0
+# corners: tuple of (x, y, dx, dy) where (x, y) is a corner tile and
+#     (dx, dy) points from it to the diagonal square outside the piece
+# anchors: tuple of (x, y) squares diagonal to the corners, same order as corners
+# width, height (int): size of the bounding box
+Orientation = namedtuple('Orientation', ['name', 'orientation', 'size', 'cells',
+                                         'corners', 'anchors', 'width', 'height'])
+
+def normalizeCells(coords):
+    """Return a sorted tuple of (x, y) coordinates shifted so min x and min y are 0."""
+    coords = [(int(x), int(y)) for x, y in coords]
+    xmin = min(x for x, y in coords)
+    ymin = min(y for x, y in coords)
+    return tuple(sorted((x - xmin, y - ymin) for x, y in coords))
+
+def findCorners(cells):
+    """Return (x, y, dx, dy) corners of the shape made up of cells."""
+    occupied = set(cells)
+    rtn = list()
+    for x, y in cells:
+        for dx, dy in ((-1, -1), (1, -1), (-1, 1), (1, 1)):
+            # A corner's diagonal square must not touch the piece along an edge
+            if ((x + dx, y + dy) not in occupied and (x + dx, y) not in occupied
+                and (x, y + dy) not in occupied):
+                rtn.append((x, y, dx, dy))
+    return tuple(rtn)
+
+def walkOrientations(piece):
+    """Return (orientation, cells) for each orientation piece passes through when rotated and flipped."""
+    rtn = list()
+    rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+
+    if piece.r90 and piece.r180:
+        for i in range(3):
+            piece.rotate(1)
+            rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+    elif piece.r90 and not piece.r180:
+        piece.rotate(1)
+        rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+
+    if piece.chiral:
+        piece.flipV()
+        rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+        if piece.r90 and piece.r180:
+            for i in range(3):
+                piece.rotate(1)
+                rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+        elif piece.r90 and not piece.r180:
+            piece.rotate(1)
+            rtn.append((piece.orientation, normalizeCells(zip(piece.shape[0], piece.shape[1]))))
+    return rtn
+
+def buildOrientationTable():
+    """Return (table, lookup): distinct orientations by piece name, and orientation by (name, code)."""
+    table = dict()
+    lookup = dict()
+    for cls in [F, I, L, N, P, T, U, V, W, X, Y, Z, I4, L4, N4, O, T4, I3, V3, Two, One]:
+        piece = cls()
+        entries = list()
+        byCells = dict()
+        for code, cells in walkOrientations(piece):
+            # Some pieces (W) reach the same shape under two codes; keep the first
+            if cells not in byCells:
+                corners = findCorners(cells)
+                entry = Orientation(piece.name, code, piece.size, cells, corners,
+                                    tuple((x + dx, y + dy) for x, y, dx, dy in corners),
+                                    max(x for x, y in cells) + 1,
+                                    max(y for x, y in cells) + 1)
+                byCells[cells] = entry
+                entries.append(entry)
+            lookup[(piece.name, code)] = byCells[cells]
+
+        # Codes never reached are congruent to a reduced code that was
+        for code in range(8):
+            if (piece.name, code) not in lookup:
+                piece.orientation = code
+                piece.reduceOrientation()
+                if not piece.r90:
+                    piece.orientation = 0
+                lookup[(piece.name, code)] = lookup[(piece.name, piece.orientation)]
+        table[piece.name] = tuple(entries)
+    return table, lookup
+
+orientationTable, orientationLookup = buildOrientationTable()
+
+# Everything below is read-only piece geometry shared by all games and
+# threads. Piece objects rotate and flip themselves in place, so they are
+# only used above to build the table, never to answer queries.
+pieceSizes = dict((name, entries[0].size) for name, entries in orientationTable.items())
+
+def orientationCells(name, orientation, xmin = 0, ymin = 0):
+    """Return the (x, y) squares covered by the named piece in orientation with its bounding box at (xmin, ymin)."""
+    entry = orientationLookup[(name, orientation)]
+    return tuple((x + xmin, y + ymin) for x, y in entry.cells)
+
+def matchingOrientation(name, compare):
+    """Return the orientation of the named piece that matches the shape in compare (a 2xn array of coordinates), or -1 if none does."""
+    cells = normalizeCells(zip(compare[0], compare[1]))
+    for entry in orientationTable[name]:
+        if entry.cells == cells:
+            return entry.orientation
+    return -1
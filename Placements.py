@@ -0,0 +1,98 @@
+# PLACEMENTS.PY
+# Table of every on-board placement of every piece, so that a move can be
+# passed around as a small int ID
+
+# A move is the ID of a placement, or PASS. IDs are laid out orientation by
+# orientation, row by row, so the ID of a placement can be computed from its
+# orientation entry and position without a lookup.
+
+import numbers
+from collections import namedtuple
+import Pieces
+import Boards
+
+PASS = 0
+
+# id (int): placement ID
+# name (str), orientation (int): piece and orientation code, as in Pieces
+# entry: the piece's Pieces.Orientation entry
+# xmin, ymin (int): position of the bounding box on the board
+# size (int): number of tiles
+# cells: padded squares covered (see Boards.cellIndex)
+# edges: padded squares edge adjacent to the placement
+# corners: padded squares of its corner tiles, one of which must be an
+#     anchor of the player placing it
+# mask: bitboard of cells
+Placement = namedtuple('Placement', ['id', 'name', 'orientation', 'entry', 'xmin', 'ymin',
+                                     'size', 'cells', 'edges', 'corners', 'mask'])
+
+def initPlacements():
+    """Return (table, bases): every placement indexed by ID, with None at PASS, and the first ID of each (name, orientation)."""
+    table = [None]
+    bases = dict()
+    for name, entries in sorted(Pieces.orientationTable.items()):
+        for entry in entries:
+            bases[(name, entry.orientation)] = len(table)
+
+            # Squares of the entry placed at (0, 0); placing it at (xmin,
+            # ymin) shifts every padded square by ymin * width + xmin
+            cells = set(entry.cells)
+            around = set()
+            for x, y in entry.cells:
+                for nx, ny in ((x+1, y), (x, y+1), (x-1, y), (x, y-1)):
+                    if (nx, ny) not in cells:
+                        around.add((nx, ny))
+            tiles = tuple(Boards.cellIndex(x, y) for x, y in entry.cells)
+            edges = tuple(sorted(Boards.cellIndex(x, y) for x, y in around))
+            corners = tuple(sorted(set(Boards.cellIndex(x, y) for x, y, dx, dy in entry.corners)))
+            mask = Boards.cellsMask(entry.cells)
+
+            for ymin in range(Boards.boardsize - entry.height + 1):
+                for xmin in range(Boards.boardsize - entry.width + 1):
+                    shift = ymin * Boards.width + xmin
+                    table.append(Placement(len(table), name, entry.orientation, entry,
+                                           xmin, ymin, entry.size,
+                                           tuple(cell + shift for cell in tiles),
+                                           tuple(cell + shift for cell in edges),
+                                           tuple(cell + shift for cell in corners),
+                                           mask << shift))
+    return tuple(table), bases
+
+table, bases = initPlacements()
+
+# Placements of each piece, in ID order
+byName = dict((name, tuple(placement for placement in table[1:] if placement.name == name))
+              for name in Pieces.orientationTable)
+
+def placementId(entry, xmin, ymin):
+    """Return the ID of orientation entry placed at (xmin, ymin), which must be on the board."""
+    return (bases[(entry.name, entry.orientation)]
+            + ymin * (Boards.boardsize - entry.width + 1) + xmin)
+
+def fromTuple(move):
+    """Return the ID of a (name, orientation, xmin, ymin) move, or None if it is not on the board."""
+    name, orientation, xmin, ymin = move
+    entry = Pieces.orientationLookup.get((name, orientation))
+    if entry is None:
+        return None
+    if (xmin < 0 or ymin < 0 or xmin + entry.width > Boards.boardsize
+        or ymin + entry.height > Boards.boardsize):
+        return None
+    return placementId(entry, xmin, ymin)
+
+def toTuple(move):
+    """Return move ID as a (name, orientation, xmin, ymin) tuple, or 'pass!' for PASS."""
+    if move == PASS:
+        return 'pass!'
+    placement = table[move]
+    return (placement.name, placement.orientation, placement.xmin, placement.ymin)
+
+def moveId(move):
+    """Return the ID of a move given as an ID, a tuple or a pass ('pass!' or list()), or None if it is not a valid move."""
+    if isinstance(move, numbers.Integral):
+        if 0 <= move < len(table):
+            return int(move)
+        return None
+    if len(move) != 4: # Then move is a pass
+        return PASS
+    return fromTuple(move)
@@ -6,11 +6,15 @@ import pdb
 import random
 import Gamestate
 import Pieces
+import Placements
 
 def utility(gamestate):
     """Returns a utility vector for a gamestate where 0 is tie, -1 is loss, 1 is win."""
+    return scoreUtility(gamestate.getScores())
+
+def scoreUtility(scores):
+    """Returns a utility vector for a list of final scores where 0 is tie, -1 is loss, 1 is win."""
     utilityVector = [-1,-1,-1,-1]
-    scores = gamestate.getScores()
     hasHighest = [False,False,False,False]
     hasHighestCount = 0
     highest = scores[0]
@@ -58,11 +62,11 @@ def weightedRandomMove(moves):
     """Return a random move from moves, weighted by piece size."""
     weightedlist = list()
     for move in moves:
-        if move != 'pass!':
-            for i in range(0, Gamestate.Gamestate.referenceHand[move[0]].size):
+        if move != Placements.PASS:
+            for i in range(0, Placements.table[move].size):
                 weightedlist.append(move)
         else:
-            weightedlist.append('pass!')
+            weightedlist.append(Placements.PASS)
                 
     return random.choice(weightedlist)
 
@@ -81,6 +85,16 @@ class Player:
         
 class AIPlayer(Player):
     """Abstract AI player class."""
+
+    # SearchBudget.SearchBudget limiting each search, for players that
+    # search; None for no limit
+    budget = None
+
+    def __init__(self, color, budget = None):
+        Player.__init__(self, color)
+        if budget is not None:
+            self.budget = budget
+
     def getMove(self, update):
         #IMPLEMENT THIS
         return list()
@@ -92,11 +106,9 @@ class veryStupidAIPlayer(AIPlayer):
         if move != False:
             return move
         else:
-            return 'pass!'
+            return Placements.PASS
 
 class weightedRandomPlayer(AIPlayer):
     """AI player which makes a random move weighted by piece size"""
     def getMove(self, update):
-        moves = update.listMoves()
-        move = weightedRandomMove(moves)
-        return move
+        return update.weightedRandomMove()
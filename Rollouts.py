@@ -0,0 +1,247 @@
+# ROLLOUTS.PY
+# Plays a game out to the end from a gamestate as fast as possible, for
+# Monte Carlo playouts
+
+# A rollout copies what it needs of the gamestate into a scratch Rollout -
+# per color bitboards of blocked squares, corner key sets, hands and scores -
+# and then places pieces there without checking them again or keeping
+# move caches, Zobrist keys or undo information.
+
+# Players never pass while a piece fits; a color with nothing that fits
+# can never move again and is skipped, each skip counting as a pass.
+
+import random
+import threading
+import Boards
+import Gamestate
+import Pieces
+import Players
+
+# Policies: a legal move chosen uniformly at random, one chosen at random
+# weighted by piece size, or the first one found, largest pieces first
+UNIFORM = 'uniform'
+WEIGHTED = 'weighted'
+FIRSTFIT = 'firstFit'
+policies = (UNIFORM, WEIGHTED, FIRSTFIT)
+
+def initEdgeMasks():
+    """Return the bitboard of the squares edge adjacent to each orientation placed at (0, 0), keyed by (name, orientation)."""
+    rtn = dict()
+    for name, entries in Pieces.orientationTable.items():
+        for entry in entries:
+            cells = set(entry.cells)
+            edges = set()
+            for x, y in entry.cells:
+                for nx, ny in ((x+1, y), (x, y+1), (x-1, y), (x, y-1)):
+                    if (nx, ny) not in cells:
+                        edges.add((nx, ny))
+            rtn[(name, entry.orientation)] = Boards.cellsMask(edges)
+    return rtn
+
+def initWeights():
+    """Return the piece weights for sampling each policy's moves with Gamestate.sampleTable proposals, keyed by policy."""
+    weights, proposals, tileKeys = Gamestate.Gamestate.sampleTable
+    uniform = dict((name, len(proposals[(name, 0)])) for name in Pieces.orientationTable)
+    return {UNIFORM: uniform, WEIGHTED: weights}
+
+entryMasks = Boards.Bitboard.entryMasks
+edgeMasks = initEdgeMasks()
+policyWeights = initWeights()
+
+class Rollout(object):
+    """Scratch state of one game being played out."""
+
+    # blocked: per color, bitboard of squares it cannot cover - off the
+    #     board, occupied or edge adjacent to its own tiles
+    # corners: per color, set of open corner keys, as in Gamestate
+    # hands, scores: per color, as in Gamestate
+    # exhausted: bit color - 1 set once color can never move again
+    # turn, passCount: as in Gamestate
+    __slots__ = ('blocked', 'corners', 'hands', 'scores', 'exhausted', 'turn', 'passCount')
+
+    # Proposals rejected before looking at every placement instead
+    sampleTries = 64
+
+    def __init__(self):
+        self.blocked = [0, 0, 0, 0]
+        self.corners = [set(), set(), set(), set()]
+        self.hands = [0, 0, 0, 0]
+        self.scores = [0, 0, 0, 0]
+        self.exhausted = 0
+        self.turn = 1
+        self.passCount = 0
+
+    def reset(self, gamestate):
+        """Load gamestate into this scratch state."""
+        self.load(pack(gamestate))
+
+    def load(self, packed):
+        """Load a position packed by pack into this scratch state."""
+        blocked, corners, hands, scores, self.exhausted, self.turn, self.passCount = packed
+        for i in range(4):
+            self.blocked[i] = blocked[i]
+            self.corners[i].clear()
+            self.corners[i].update(corners[i])
+            self.hands[i] = hands[i]
+            self.scores[i] = scores[i]
+
+    def play(self, policy):
+        """Play the game out to the end with policy."""
+        while self.passCount < 4 and self.exhausted != 0xf:
+            color = self.turn
+            bit = 1 << (color - 1)
+            move = None
+            if not self.exhausted & bit:
+                if policy == FIRSTFIT:
+                    move = self.firstFit(color)
+                else:
+                    move = self.sample(color, policyWeights[policy])
+            if move is None:
+                self.exhausted |= bit
+                self.passCount = self.passCount + 1
+            else:
+                self.place(color, *move)
+                self.passCount = 0
+            self.turn = self.turn % 4 + 1
+
+    def fits(self, color, entry, xmin, ymin):
+        """Return whether orientation entry fits at (xmin, ymin) for color."""
+        if (xmin < 0 or ymin < 0 or xmin + entry.width > Boards.boardsize
+            or ymin + entry.height > Boards.boardsize):
+            return False
+        mask = entryMasks[(entry.name, entry.orientation)] << (ymin * Boards.width + xmin)
+        return not mask & self.blocked[color - 1]
+
+    def sample(self, color, weights):
+        """Return a random (entry, xmin, ymin) move for color with pieces weighted by weights, or None if nothing fits.
+
+        Proposals are drawn and accepted as in Gamestate.weightedRandomMove;
+        after sampleTries rejections every move is listed and one drawn."""
+        corners = self.corners[color - 1]
+        if not corners or not self.hands[color - 1]:
+            return None
+        proposals, tileKeys = Gamestate.Gamestate.sampleTable[1:]
+        names = Gamestate.handNames(self.hands[color - 1])
+        total = sum(weights[name] for name in names)
+        keys = tuple(corners)
+        for i in range(Rollout.sampleTries):
+            draw = random.randrange(total)
+            for name in names:
+                draw = draw - weights[name]
+                if draw < 0:
+                    break
+            key = random.choice(keys)
+            entry, x, y = random.choice(proposals[(name, key & 3)])
+            ax, ay = Boards.cornerSquare(key)
+            xmin = ax - x
+            ymin = ay - y
+            if not self.fits(color, entry, xmin, ymin):
+                continue
+            shift = 4 * (ymin * Boards.width + xmin)
+            if min(tileKey + shift for tileKey in tileKeys[(name, entry.orientation)]
+                   if tileKey + shift in corners) == key:
+                return entry, xmin, ymin
+
+        # List every move once, from the lowest open corner key it covers
+        moves = list()
+        for name in names:
+            weight = weights[name] // len(proposals[(name, 0)])
+            for key in corners:
+                ax, ay = Boards.cornerSquare(key)
+                for entry, x, y in proposals[(name, key & 3)]:
+                    xmin = ax - x
+                    ymin = ay - y
+                    if not self.fits(color, entry, xmin, ymin):
+                        continue
+                    shift = 4 * (ymin * Boards.width + xmin)
+                    if min(tileKey + shift for tileKey in tileKeys[(name, entry.orientation)]
+                           if tileKey + shift in corners) == key:
+                        moves.extend([(entry, xmin, ymin)] * weight)
+        if not moves:
+            return None
+        return random.choice(moves)
+
+    def firstFit(self, color):
+        """Return the first (entry, xmin, ymin) move found for color, largest pieces first, or None if nothing fits."""
+        corners = self.corners[color - 1]
+        if not corners:
+            return None
+        proposals = Gamestate.Gamestate.sampleTable[1]
+        for name in Gamestate.handNames(self.hands[color - 1]):
+            for key in corners:
+                ax, ay = Boards.cornerSquare(key)
+                for entry, x, y in proposals[(name, key & 3)]:
+                    if self.fits(color, entry, ax - x, ay - y):
+                        return entry, ax - x, ay - y
+        return None
+
+    def place(self, color, entry, xmin, ymin):
+        """Put orientation entry down at (xmin, ymin) in color, without checking that it is legal."""
+        index = (entry.name, entry.orientation)
+        shift = ymin * Boards.width + xmin
+        mask = entryMasks[index] << shift
+        for other in range(4):
+            self.blocked[other] |= mask
+        self.blocked[color - 1] |= edgeMasks[index] << shift
+
+        # Update corner sets as Gamestate.updateCorners does
+        covered, edges, anchors, byDirection = Gamestate.Gamestate.cornerKeys[index]
+        shift = 4 * shift
+        covered = [key + shift for key in covered]
+        for corners in self.corners:
+            corners.difference_update(covered)
+        corners = self.corners[color - 1]
+        corners.difference_update([key + shift for key in edges])
+        blocked = self.blocked[color - 1]
+        for key in anchors:
+            if not (blocked >> ((key + shift) >> 2)) & 1:
+                corners.add(key + shift)
+
+        # Update hand and score, with bonuses for playing every piece
+        hand = self.hands[color - 1] & ~Gamestate.pieceBits[entry.name]
+        self.hands[color - 1] = hand
+        if hand == 0:
+            if entry.name == "One":
+                self.scores[color - 1] = Gamestate.monominoLastBonus
+            else:
+                self.scores[color - 1] = Gamestate.allPlayedBonus
+            self.exhausted |= 1 << (color - 1)
+        else:
+            self.scores[color - 1] = self.scores[color - 1] + entry.size
+
+def pack(gamestate):
+    """Return what a rollout needs of gamestate as a tuple of ints and tuples of ints, for sending to another process.
+
+    The tuple is (blocked, corners, hands, scores, exhausted, turn,
+    passCount), as in Rollout."""
+    return (tuple(Boards.Bitboard.allSquares & ~gamestate.backend.freeMask(color)
+                  for color in range(1, 5)),
+            tuple(tuple(gamestate.getCorners(color)) for color in range(1, 5)),
+            tuple(gamestate.hands),
+            tuple(gamestate.scores),
+            gamestate.exhausted,
+            gamestate.turn,
+            gamestate.passCount)
+
+# Scratch state reused by every rollout in the same thread, so games and
+# search threads sharing a process do not play over each other
+local = threading.local()
+
+def scratchState():
+    """Return this thread's scratch Rollout, creating it on first use."""
+    scratch = getattr(local, 'scratch', None)
+    if scratch is None:
+        scratch = local.scratch = Rollout()
+    return scratch
+
+def rollout(gamestate, policy = WEIGHTED):
+    """Play gamestate out to the end with policy and return (final scores, utility vector)."""
+    return packedRollout(pack(gamestate), policy)
+
+def packedRollout(packed, policy = WEIGHTED):
+    """Play a position packed by pack out to the end with policy and return (final scores, utility vector)."""
+    scratch = scratchState()
+    scratch.load(packed)
+    scratch.play(policy)
+    scores = list(scratch.scores)
+    return scores, Players.scoreUtility(scores)
@@ -0,0 +1,156 @@
+# SEARCHBUDGET.PY
+# Limits on how long a player searches for a move
+
+# A search asks its budget before each iteration whether it may start
+# another, and tells it how many nodes each one added; it stops at
+# whichever limit is reached first, but always allows the first iteration
+# so a search has something to go on. Time and memory are only looked at
+# every checkEvery iterations, since iterations can be much cheaper than
+# reading the clock.
+
+import os
+import sys
+import threading
+import time
+
+try:
+    pageSize = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    pageSize = 4096
+
+def initClock():
+    """Return a function giving monotonic time in seconds.
+
+    This is time.monotonic on Python 3. On Python 2 under Linux it is
+    clock_gettime(CLOCK_MONOTONIC) called through ctypes. Anywhere else it
+    falls back to wall-clock time."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes
+    except ImportError:
+        return time.time
+    gettime = None
+    for name in ('librt.so.1', 'libc.so.6'):
+        try:
+            gettime = ctypes.CDLL(name, use_errno = True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    if gettime is None:
+        return time.time
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        spec = Timespec()
+        if gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+clock = initClock()
+
+def currentMemory():
+    """Return the memory this process is using now (its resident set size) in bytes, or None if it cannot be read.
+
+    Read from /proc, so memory limits are ignored where there is none.
+    The peak use would never go down again once a limit was reached."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * pageSize
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def describe(report):
+    """Return a line describing a SearchBudget report."""
+    return ("Search used %(milliseconds)d ms, %(iterations)d iterations, %(nodes)d nodes"
+            " (stopped by: %(stopped)s)" % report)
+
+class SearchBudget(object):
+    """Limits on a search in milliseconds, iterations, nodes added and memory in use in bytes; None means no limit."""
+
+    def __init__(self, milliseconds = None, iterations = None, nodes = None,
+                 memory = None, checkEvery = 16):
+        self.milliseconds = milliseconds
+        self.iterations = iterations
+        self.nodes = nodes
+        self.memory = memory
+        self.checkEvery = checkEvery
+        self.start()
+
+    def __getstate__(self):
+        """Return what pickling needs, leaving out the lock."""
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start counting a new search against this budget."""
+        # startTime: clock() when the search started
+        # iterationsUsed, nodesUsed: counted so far
+        # stopped: name of the limit reached, or None
+        self.lock = threading.Lock()
+        self.startTime = clock()
+        self.iterationsUsed = 0
+        self.nodesUsed = 0
+        self.stopped = None
+
+    def nextIteration(self):
+        """Return whether another iteration may start, counting it if so.
+
+        Safe to call from several threads searching together."""
+        with self.lock:
+            if self.stopped is not None:
+                return False
+            if self.iterationsUsed == 0:
+                pass # The first iteration is always allowed
+            elif self.iterations is not None and self.iterationsUsed >= self.iterations:
+                self.stopped = 'iterations'
+            elif self.nodes is not None and self.nodesUsed >= self.nodes:
+                self.stopped = 'nodes'
+            elif self.iterationsUsed % self.checkEvery == 0:
+                if (self.milliseconds is not None
+                    and (clock() - self.startTime) * 1000 >= self.milliseconds):
+                    self.stopped = 'milliseconds'
+                elif self.memory is not None:
+                    used = currentMemory()
+                    if used is not None and used >= self.memory:
+                        self.stopped = 'memory'
+            if self.stopped is not None:
+                return False
+            self.iterationsUsed = self.iterationsUsed + 1
+            return True
+
+    def addNodes(self, count):
+        """Count count nodes added by the search."""
+        with self.lock:
+            self.nodesUsed = self.nodesUsed + count
+
+    def share(self, parts):
+        """Return a new budget for one of parts searches run side by side, with iteration and node limits split between them."""
+        rtn = SearchBudget(self.milliseconds, self.iterations, self.nodes,
+                           self.memory, self.checkEvery)
+        if self.iterations is not None:
+            rtn.iterations = -(-self.iterations // parts)
+        if self.nodes is not None:
+            rtn.nodes = -(-self.nodes // parts)
+        return rtn
+
+    def report(self):
+        """Return a dict of what the search used so far, and the limit that stopped it (None if none did)."""
+        return {'milliseconds': int((clock() - self.startTime) * 1000),
+                'iterations': self.iterationsUsed,
+                'nodes': self.nodesUsed,
+                'memory': currentMemory(),
+                'stopped': self.stopped}